@@ -0,0 +1,184 @@
+"""Offline benchmark of the ESI hot paths and the trade pipeline, stage by
+stage, against the fixture stub server.
+
+    python -m benchmarks.bench_pipeline --latency 0.02 --error-rate 0.01
+
+Needs a Redis at BENCH_REDIS_URL (redis://localhost:6379/15 by default).
+Only the keys the stages write are cleared between runs. The fixtures are
+generated when benchmarks/fixtures does not exist yet. Each stage reports
+wall time, peak Python memory and the requests the stub served.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from benchmarks import fixtures
+from benchmarks.stub import StubServer
+
+# keys written by the stages, cleared so every run starts cold
+KEY_PATTERNS = ('esi_response_*', 'access_token_*', '{jita_lowest_prices}*', 'month_volume_*',
+                '{structure_candidates_*', '{order_book_*', 'single_flight_*', 'eve_jwks', 'flask_cache_*',
+                'metrics')
+
+
+def create_app(stub, database, sde_path):
+    os.environ['FLASK_CONFIG'] = 'testing'
+    os.environ['ESI_BASE_URL'] = stub.url + '/latest'
+    os.environ['SSO_BASE_URL'] = stub.url
+    os.environ['SDE_PATH'] = sde_path
+    os.environ['REDIS_URL'] = os.environ.get('BENCH_REDIS_URL', 'redis://localhost:6379/15')
+
+    from evelogi import create_app
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.config['SDE_PATH'] = sde_path
+    return app
+
+
+def prepare(app, stub, data):
+    """Create the tables, the SDE artifact and a user owning the fixture structure.
+    """
+    from evelogi.extensions import db
+    from evelogi.models.account import Role, User, Character_, RefreshToken, Structure
+    from evelogi.sde import StaticData, TypeTable
+    from evelogi.utils import get_redis
+
+    r = get_redis()
+    for pattern in KEY_PATTERNS:
+        for key in r.scan_iter(pattern):
+            r.delete(key)
+
+    systems = np.array(data['systems'], dtype=np.int64)
+    StaticData(TypeTable.build([tuple(row) for row in data['types']]),
+               systems[:, 0], systems[:, 1]).save(app.config['SDE_PATH'])
+
+    db.drop_all()
+    db.create_all()
+    Role.init_role()
+    manifest = stub.manifest
+    user = User()
+    character = Character_(name='Character {}'.format(manifest['character_id']),
+                           character_id=manifest['character_id'],
+                           owner_hash='owner{}'.format(manifest['character_id']))
+    character.refresh_tokens.append(RefreshToken(
+        token=base64.b64encode(str(manifest['character_id']).encode()).decode()))
+    user.characters.append(character)
+    structure = Structure(structure_id=str(manifest['structure_id']), name='Benchmark',
+                          jita_to_fee=800, sales_tax=3.6, brokers_fee=1.0, character=character)
+    db.session.add_all([user, character, structure])
+    db.session.commit()
+    return structure.id
+
+
+def stages(app, stub, structure_id, types):
+    """The stages in run order, as (name, callable) pairs. Later stages see
+    the caches the earlier ones filled, the `_warm` stages measure that.
+    """
+    from evelogi.extensions import esi
+    from evelogi.market import refresh_jita_lowest_prices, get_jita_sell_orders
+    from evelogi.candidates import get_month_volumes, materialize_structures
+    from evelogi.models.account import Character_, Structure
+    from evelogi.tokens import token_manager
+
+    manifest = stub.manifest
+    jita_path = esi.url('/markets/{}/orders/'.format(manifest['jita_region_id']), order_type='sell')
+    type_ids = [row[0] for row in types]
+
+    def character_tokens():
+        character = Character_.query.filter_by(character_id=manifest['character_id']).first()
+        return token_manager.get(character.character_id, character.refresh_tokens[0].token)
+
+    def month_volumes():
+        return get_month_volumes(type_ids, manifest['structure_region_id'])
+
+    def materialize():
+        return materialize_structures([Structure.query.get(structure_id)])
+
+    return [
+        ('access_token', character_tokens),
+        ('get_esi_data', lambda: esi.get(jita_path)),
+        ('get_esi_data_warm', lambda: esi.get(jita_path)),
+        ('order_array_warm', get_jita_sell_orders),
+        ('jita_snapshot', refresh_jita_lowest_prices),
+        ('month_volumes', month_volumes),
+        ('month_volumes_warm', month_volumes),
+        ('trade_pipeline', materialize),
+    ]
+
+
+def measure(stub, func):
+    before = stub.snapshot()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    after = stub.snapshot()
+    counts = after['counts'] - before['counts']
+    statuses = {}
+    for (route, status), count in counts.items():
+        statuses[status] = statuses.get(status, 0) + count
+    return {'wall': wall,
+            'peak_memory': peak,
+            'requests': sum(counts.values()),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'bytes': after['bytes'] - before['bytes']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', default=fixtures.FIXTURES_DIR)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--stage', action='append', help='Only run these stages.')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    if not fixtures.exists(args.fixtures):
+        print('Generating fixtures in {}.'.format(args.fixtures))
+        fixtures.generate(args.fixtures)
+    data = fixtures.load_fixtures(args.fixtures)
+    stub = StubServer(data, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, page_size=args.page_size)
+    stub.start()
+
+    workdir = tempfile.mkdtemp(prefix='evelogi-bench-')
+    app = create_app(stub, 'sqlite:///{}'.format(os.path.join(workdir, 'bench.db')),
+                     os.path.join(workdir, 'sde'))
+
+    results = {}
+    tracemalloc.start()
+    with app.app_context():
+        structure_id = prepare(app, stub, data)
+        for name, func in stages(app, stub, structure_id, data['types']):
+            if args.stage and name not in args.stage:
+                continue
+            results[name] = measure(stub, func)
+    tracemalloc.stop()
+    stub.stop()
+
+    print('fixtures: {} ({}), latency: {}s, error rate: {}'.format(
+        args.fixtures, stub.manifest['source'], args.latency, args.error_rate))
+    print('{:<20} {:>10} {:>12} {:>9} {:>12}  {}'.format(
+        'stage', 'wall (s)', 'peak (MiB)', 'requests', 'bytes (MiB)', 'statuses'))
+    for name, result in results.items():
+        print('{:<20} {:>10.3f} {:>12.1f} {:>9} {:>12.1f}  {}'.format(
+            name, result['wall'], result['peak_memory'] / 2 ** 20, result['requests'],
+            result['bytes'] / 2 ** 20, ' '.join('{}:{}'.format(*item) for item in result['statuses'].items())))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'manifest': stub.manifest, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
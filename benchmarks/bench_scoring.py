@@ -0,0 +1,121 @@
+"""Micro-benchmark of the vectorized scoring engine against the per-type loop
+it replaced in trade().
+
+    python -m benchmarks.bench_scoring --types 15000
+"""
+import time
+import argparse
+
+import numpy as np
+
+from evelogi.scoring import score_opportunities, MIN_ESTIMATE_PROFIT, STOCKOUT_MARKUP
+
+
+def score_loop(type_ids, jita_lowest_price, local_lowest_price, volumes, packaged_volumes,
+               jita_to_fee, sales_tax, brokers_fee, margin_filter, volume_filter, limit):
+    """The scoring loop formerly inlined in trade(), without the name lookups.
+    """
+    records = []
+    for type_id in type_ids:
+        if volumes.get(type_id, 0) == 0:
+            continue
+        stockout = False
+
+        jita_price = jita_lowest_price[type_id]
+        local_price = local_lowest_price.get(type_id)
+        if local_price is None:
+            local_price = jita_price * STOCKOUT_MARKUP
+            stockout = True
+
+        packaged_volume = packaged_volumes.get(type_id)
+        if packaged_volume is None:
+            continue
+
+        jita_to_cost = float(packaged_volume * jita_to_fee)
+
+        sales_cost = local_price * \
+            (sales_tax * 0.01 + brokers_fee * 0.01)
+
+        profit_per_item = local_price - jita_price - jita_to_cost - sales_cost
+        if profit_per_item <= 0:
+            continue
+
+        margin = profit_per_item / \
+            (jita_price + jita_to_cost + sales_cost)
+        if margin < margin_filter:
+            continue
+
+        estimate_profit = profit_per_item * volumes[type_id]
+        if estimate_profit < MIN_ESTIMATE_PROFIT:
+            continue
+
+        daily_volume = round(volumes[type_id] / 30, 2)
+        if daily_volume < volume_filter:
+            continue
+
+        records.append({'type_id': type_id,
+                        'jita_sell_price': jita_price,
+                        'daily_volume': daily_volume,
+                        'local_price': local_price,
+                        'estimate_profit': estimate_profit,
+                        'margin': margin,
+                        'stockout': stockout
+                        })
+    records.sort(key=lambda item: item.get(
+        'estimate_profit'), reverse=True)
+    return records[:limit]
+
+
+def make_market(n, seed=0):
+    rng = np.random.default_rng(seed)
+    type_ids = np.arange(1, n + 1)
+    jita = rng.lognormal(13, 2.5, n)
+    local = jita * rng.uniform(0.8, 1.8, n)
+    local[rng.random(n) < 0.3] = np.nan
+    volumes = rng.integers(0, 20000, n)
+    packaged = rng.choice([0.01, 0.1, 1, 5, 10, 2500, 10000], n)
+    packaged[rng.random(n) < 0.01] = np.nan
+    return type_ids, jita, local, volumes, packaged
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--types', type=int, default=15000)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    type_ids, jita, local, volumes, packaged = make_market(args.types)
+    params = dict(jita_to_fee=800, sales_tax=3.6, brokers_fee=1.0,
+                  margin_filter=0.05, volume_filter=0.5, limit=args.limit)
+
+    # the loop works on the dicts trade() used to build
+    ids = type_ids.tolist()
+    jita_map = dict(zip(ids, jita.tolist()))
+    local_map = {t: p for t, p in zip(ids, local.tolist()) if not np.isnan(p)}
+    volume_map = dict(zip(ids, volumes.tolist()))
+    packaged_map = {t: v for t, v in zip(ids, packaged.tolist()) if not np.isnan(v)}
+
+    loop_time, expected = best_of(args.repeat, lambda: score_loop(
+        ids, jita_map, local_map, volume_map, packaged_map, **params))
+    numpy_time, result = best_of(args.repeat, lambda: score_opportunities(
+        type_ids, jita, local, volumes, packaged, **params))
+
+    assert result['type_id'].tolist() == [record['type_id'] for record in expected]
+
+    print('types: {}, results: {}'.format(args.types, len(expected)))
+    print('loop:  {:8.3f} ms'.format(loop_time * 1000))
+    print('numpy: {:8.3f} ms ({:.1f}x)'.format(numpy_time * 1000, loop_time / numpy_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Cold-start benchmark of create_app(), each run in a fresh interpreter the
+way a new gunicorn worker or `flask` command starts.
+
+    DATABASE_URL=mysql://... python -m benchmarks.bench_startup --runs 10
+
+With --reflect every run also reflects the whole schema, which is what
+create_app() used to do at boot, for comparison.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+from evelogi import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+if {reflect}:
+    from sqlalchemy.ext.automap import automap_base
+    from evelogi.extensions import db
+    with app.app_context():
+        automap_base().prepare(db.engine, reflect=True)
+reflected = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'create_app': created - imported,
+                  'reflect': reflected - created, 'total': reflected - start}}))
+"""
+
+
+def run_once(reflect):
+    env = dict(os.environ, FLASK_ENV=os.environ.get('FLASK_ENV', 'development'))
+    output = subprocess.run([sys.executable, '-c', CHILD.format(reflect=reflect)],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--reflect', action='store_true',
+                        help='Also reflect the whole schema, as boots used to.')
+    args = parser.parse_args()
+
+    runs = [run_once(args.reflect) for _ in range(args.runs)]
+    print('runs: {}, database: {}'.format(args.runs, os.environ.get('DATABASE_URL')))
+    for stage in ('import', 'create_app', 'reflect', 'total'):
+        timings = [run[stage] * 1000 for run in runs]
+        print('{:<12} median {:8.1f} ms, max {:8.1f} ms'.format(
+            stage + ':', statistics.median(timings), max(timings)))
+
+
+if __name__ == '__main__':
+    main()
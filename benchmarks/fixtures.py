@@ -0,0 +1,246 @@
+"""Fixtures for the offline benchmarks: ESI market data shaped like the real
+responses, plus an SSO signing key for JWKS and token responses.
+
+    python -m benchmarks.fixtures generate --types 3000
+    python -m benchmarks.fixtures record --types 3000
+
+`generate` builds deterministic synthetic data. `record` downloads the public
+Jita order book, market history and type data from ESI and anonymizes it:
+order ids are renumbered, a second region's book stands in for the orders of
+a structure and character orders are sampled from the book. Secrets are
+never recorded, the SSO key is always generated locally.
+"""
+import os
+import gzip
+import json
+import random
+import argparse
+from datetime import date, datetime, timedelta
+
+import rsa
+import requests
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+ESI_BASE_URL = 'https://esi.evetech.net/latest'
+
+JITA_REGION_ID = 10000002
+JITA_SYSTEM_ID = 30000142
+JITA_STATION_ID = 60003760
+STRUCTURE_REGION_ID = 10000043
+STRUCTURE_SYSTEM_ID = 30002187
+STRUCTURE_ID = 1000000000001
+CHARACTER_ID = 90000001
+
+
+def dump(path, data):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def load(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_fixtures(path=FIXTURES_DIR):
+    """Load every fixture of a directory into a dict keyed by file name.
+    """
+    fixtures = {}
+    for name in os.listdir(path):
+        if name.endswith('.json.gz'):
+            fixtures[name[:-len('.json.gz')]] = load(os.path.join(path, name))
+    with open(os.path.join(path, 'sso_key.pem'), 'rb') as f:
+        fixtures['sso_key'] = f.read()
+    return fixtures
+
+
+def exists(path=FIXTURES_DIR):
+    return os.path.exists(os.path.join(path, 'manifest.json.gz'))
+
+
+def _order(rng, order_id, type_id, price, location_id, system_id, is_buy_order, issued):
+    volume_total = rng.choice([1, 5, 10, 100, 1000, 10000])
+    return {'duration': 90,
+            'is_buy_order': is_buy_order,
+            'issued': issued,
+            'location_id': location_id,
+            'min_volume': 1,
+            'order_id': order_id,
+            'price': round(price, 2),
+            'range': 'region',
+            'system_id': system_id,
+            'type_id': type_id,
+            'volume_remain': rng.randint(1, volume_total),
+            'volume_total': volume_total}
+
+
+def _character_orders(rng, book, count):
+    orders = []
+    for order in rng.sample(book, min(count, len(book))):
+        order = {key: value for key, value in order.items() if key != 'system_id'}
+        order.update(region_id=STRUCTURE_REGION_ID, is_corporation=False)
+        orders.append(order)
+    return orders
+
+
+def _write(path, types, jita_orders, structure_orders, character_orders, histories, source, seed):
+    os.makedirs(path, exist_ok=True)
+    dump(os.path.join(path, 'types.json.gz'), types)
+    dump(os.path.join(path, 'systems.json.gz'), [[JITA_SYSTEM_ID, JITA_REGION_ID],
+                                                 [STRUCTURE_SYSTEM_ID, STRUCTURE_REGION_ID]])
+    dump(os.path.join(path, 'region_orders_{}.json.gz'.format(JITA_REGION_ID)), jita_orders)
+    dump(os.path.join(path, 'structure_orders_{}.json.gz'.format(STRUCTURE_ID)), structure_orders)
+    dump(os.path.join(path, 'structures.json.gz'), {str(STRUCTURE_ID): {
+        'name': 'Benchmark Market', 'solar_system_id': STRUCTURE_SYSTEM_ID}})
+    dump(os.path.join(path, 'character_orders_{}.json.gz'.format(CHARACTER_ID)), character_orders)
+    for region_id, history in histories.items():
+        dump(os.path.join(path, 'history_{}.json.gz'.format(region_id)), history)
+
+    # the SSO key signs the access tokens the stub hands out
+    public_key, private_key = rsa.newkeys(2048)
+    with open(os.path.join(path, 'sso_key.pem'), 'wb') as f:
+        f.write(private_key.save_pkcs1())
+
+    dump(os.path.join(path, 'manifest.json.gz'), {
+        'source': source,
+        'seed': seed,
+        'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'types': len(types),
+        'jita_orders': len(jita_orders),
+        'structure_orders': len(structure_orders),
+        'character_orders': len(character_orders),
+        'history_types': {str(region_id): len(history) for region_id, history in histories.items()},
+        'jita_region_id': JITA_REGION_ID,
+        'structure_region_id': STRUCTURE_REGION_ID,
+        'structure_id': STRUCTURE_ID,
+        'character_id': CHARACTER_ID,
+    })
+
+
+def generate(path=FIXTURES_DIR, types=3000, orders=100000, history_days=120, seed=0):
+    """Write synthetic fixtures. The same arguments always give the same data.
+    """
+    rng = random.Random(seed)
+    type_ids = sorted(rng.sample(range(18, 60000), types))
+    issued = (datetime(2022, 3, 1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    base_prices = {type_id: 10 ** rng.uniform(0, 9) for type_id in type_ids}
+    type_rows = [[type_id, 'Type {}'.format(type_id), volume, volume if rng.random() > 0.05 else volume / 10]
+                 for type_id, volume in ((type_id, rng.choice([0.01, 0.1, 1, 5, 10, 2500]))
+                                         for type_id in type_ids)]
+
+    jita_orders = []
+    for order_id in range(1, orders + 1):
+        type_id = rng.choice(type_ids)
+        is_buy_order = rng.random() < 0.4
+        price = base_prices[type_id] * rng.uniform(0.7, 0.95 if is_buy_order else 1.5)
+        location_id = JITA_STATION_ID if rng.random() < 0.7 else 60000000 + rng.randint(1, 9999)
+        jita_orders.append(_order(rng, order_id, type_id, price, location_id, JITA_SYSTEM_ID,
+                                  is_buy_order, issued))
+
+    structure_orders = []
+    for order_id in range(orders + 1, orders + orders // 20 + 1):
+        type_id = rng.choice(type_ids)
+        order = _order(rng, order_id, type_id, base_prices[type_id] * rng.uniform(0.9, 2.0),
+                       STRUCTURE_ID, STRUCTURE_SYSTEM_ID, rng.random() < 0.2, issued)
+        del order['system_id']
+        structure_orders.append(order)
+
+    today = date.today()
+    histories = {}
+    for region_id in (JITA_REGION_ID, STRUCTURE_REGION_ID):
+        history = {}
+        for type_id in type_ids:
+            if rng.random() < 0.1:
+                # never traded in the region, ESI answers 404
+                continue
+            daily = 10 ** rng.uniform(0, 4)
+            history[str(type_id)] = [
+                {'average': round(base_prices[type_id], 2),
+                 'date': (today - timedelta(days=day)).isoformat(),
+                 'highest': round(base_prices[type_id] * 1.1, 2),
+                 'lowest': round(base_prices[type_id] * 0.9, 2),
+                 'order_count': rng.randint(1, 100),
+                 'volume': int(daily * rng.uniform(0.5, 1.5))}
+                for day in range(history_days, 0, -1)]
+        histories[region_id] = history
+
+    _write(path, type_rows, jita_orders, structure_orders,
+           _character_orders(rng, structure_orders, 300), histories, 'generated', seed)
+
+
+def _get_pages(session, url, **params):
+    params['datasource'] = 'tranquility'
+    res = session.get(url, params=params, timeout=30)
+    res.raise_for_status()
+    data = res.json()
+    for page in range(2, int(res.headers.get('X-Pages', 1)) + 1):
+        res = session.get(url, params=dict(params, page=page), timeout=30)
+        res.raise_for_status()
+        data += res.json()
+    return data
+
+
+def record(path=FIXTURES_DIR, types=3000, seed=0):
+    """Record fixtures from the public ESI endpoints, anonymized.
+    """
+    rng = random.Random(seed)
+    session = requests.Session()
+    session.headers['User-Agent'] = 'evelogi-benchmarks'
+
+    jita_orders = _get_pages(session, '{}/markets/{}/orders/'.format(ESI_BASE_URL, JITA_REGION_ID),
+                             order_type='all')
+    counts = {}
+    for order in jita_orders:
+        counts[order['type_id']] = counts.get(order['type_id'], 0) + 1
+    type_ids = sorted(sorted(counts, key=counts.get, reverse=True)[:types])
+
+    local_orders = _get_pages(session, '{}/markets/{}/orders/'.format(ESI_BASE_URL, STRUCTURE_REGION_ID),
+                              order_type='all')
+    structure_orders = []
+    for order in local_orders:
+        order = {key: value for key, value in order.items() if key != 'system_id'}
+        order['location_id'] = STRUCTURE_ID
+        structure_orders.append(order)
+
+    # order ids identify characters through other endpoints
+    for order_id, order in enumerate(jita_orders + structure_orders, 1):
+        order['order_id'] = order_id
+
+    histories = {JITA_REGION_ID: {}, STRUCTURE_REGION_ID: {}}
+    type_rows = []
+    for type_id in type_ids:
+        for region_id, history in histories.items():
+            res = session.get('{}/markets/{}/history/'.format(ESI_BASE_URL, region_id),
+                              params={'type_id': type_id, 'datasource': 'tranquility'}, timeout=30)
+            if res.status_code == 200:
+                history[str(type_id)] = res.json()
+        res = session.get('{}/universe/types/{}/'.format(ESI_BASE_URL, type_id),
+                          params={'datasource': 'tranquility'}, timeout=30)
+        res.raise_for_status()
+        data = res.json()
+        type_rows.append([type_id, data['name'], data.get('volume', 0),
+                          data.get('packaged_volume', data.get('volume', 0))])
+
+    _write(path, type_rows, jita_orders, structure_orders,
+           _character_orders(rng, structure_orders, 300), histories, 'recorded', seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('mode', choices=['generate', 'record'])
+    parser.add_argument('--path', default=FIXTURES_DIR)
+    parser.add_argument('--types', type=int, default=3000)
+    parser.add_argument('--orders', type=int, default=100000, help='Jita orders to generate.')
+    parser.add_argument('--history-days', type=int, default=120, help='Days of history to generate.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.mode == 'generate':
+        generate(args.path, args.types, args.orders, args.history_days, args.seed)
+    else:
+        record(args.path, args.types, args.seed)
+    print('Wrote fixtures to {}.'.format(args.path))
+
+
+if __name__ == '__main__':
+    main()
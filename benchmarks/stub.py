@@ -0,0 +1,246 @@
+"""Local stand-in for ESI and the EVE SSO, serving the benchmark fixtures.
+
+    python -m benchmarks.stub --port 8080 --latency 0.05 --error-rate 0.01
+
+Responses carry the headers the client relies on: X-Pages, ETag, Expires
+and the error limit headers, and ETags are honoured with 304s. Latency,
+page size and injected errors are configurable, and every request is
+counted per route and status.
+"""
+import time
+import json
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+from datetime import date, timedelta
+from email.utils import formatdate
+from collections import Counter
+
+from aiohttp import web
+from jose import jwt, jwk
+
+from benchmarks.fixtures import FIXTURES_DIR, load_fixtures
+
+SSO_KID = 'JWT-Signature-Key'
+
+
+class Page:
+    """A pre-encoded response body.
+    """
+
+    def __init__(self, data, pages=1):
+        self.body = json.dumps(data).encode()
+        self.etag = '"{}"'.format(hashlib.md5(self.body).hexdigest())
+        self.pages = pages
+
+
+def paginate(items, page_size):
+    chunks = [items[i:i + page_size] for i in range(0, len(items), page_size)] or [[]]
+    return [Page(chunk, len(chunks)) for chunk in chunks]
+
+
+def shift_history(history):
+    """Move the days of a recorded history so the last one is yesterday.
+    """
+    if not history:
+        return history
+    offset = date.today() - timedelta(days=1) - date.fromisoformat(history[-1]['date'])
+    return [dict(day, date=(date.fromisoformat(day['date']) + offset).isoformat()) for day in history]
+
+
+class StubServer:
+    """ESI and SSO stub serving fixtures from a background thread.
+
+    Args:
+        latency, jitter: seconds added to every response, jitter is uniform.
+        error_rate: share of ESI requests answered with a 502.
+        page_size: items per page of paginated endpoints.
+        expires: seconds until responses expire, 0 makes every request a
+            conditional one.
+    """
+
+    def __init__(self, fixtures=None, latency=0.0, jitter=0.0, error_rate=0.0, page_size=1000,
+                 expires=300, seed=0):
+        fixtures = fixtures or load_fixtures(FIXTURES_DIR)
+        self.manifest = fixtures['manifest']
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.expires = expires
+        self.rng = random.Random(seed)
+        self.counts = Counter()
+        self.bytes = 0
+        self.error_limit = 100
+        self._lock = threading.Lock()
+
+        self.region_books = {}
+        self.structure_books = {}
+        self.character_books = {}
+        self.history_pages = {}
+        for name, data in fixtures.items():
+            kind, _, key = name.rpartition('_')
+            if kind == 'region_orders':
+                self.region_books[int(key)] = {
+                    'all': paginate(data, page_size),
+                    'sell': paginate([order for order in data if not order['is_buy_order']], page_size),
+                    'buy': paginate([order for order in data if order['is_buy_order']], page_size)}
+            elif kind == 'structure_orders':
+                self.structure_books[int(key)] = paginate(data, page_size)
+            elif kind == 'character_orders':
+                self.character_books[int(key)] = Page(data)
+            elif kind == 'history':
+                self.history_pages[int(key)] = {int(type_id): Page(shift_history(days))
+                                                for type_id, days in data.items()}
+        self.structure_pages = {int(structure_id): Page(data)
+                                for structure_id, data in fixtures['structures'].items()}
+
+        self.private_key = fixtures['sso_key']
+        public = jwk.construct(self.private_key, 'RS256').public_key().to_dict()
+        public.update(kid=SSO_KID, alg='RS256', use='sig')
+        self.jwks = Page({'keys': [public]})
+
+        self._loop = None
+        self._runner = None
+        self.url = None
+
+    def snapshot(self):
+        """Copy of the counters, subtract two to get the requests of a stage.
+        """
+        with self._lock:
+            return {'counts': Counter(self.counts), 'bytes': self.bytes}
+
+    def _count(self, route, status, size):
+        with self._lock:
+            self.counts[(route, status)] += 1
+            self.bytes += size
+
+    async def _respond(self, request, route, page, cacheable=True):
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        headers = {'X-ESI-Error-Limit-Reset': '60'}
+        if route not in ('jwks', 'token') and self.rng.random() < self.error_rate:
+            with self._lock:
+                self.error_limit = max(self.error_limit - 1, 0)
+            headers['X-ESI-Error-Limit-Remain'] = str(self.error_limit)
+            self._count(route, 502, 0)
+            return web.json_response({'error': 'injected error'}, status=502, headers=headers)
+        headers['X-ESI-Error-Limit-Remain'] = str(self.error_limit)
+        if page is None:
+            self._count(route, 404, 0)
+            return web.json_response({'error': 'not found'}, status=404, headers=headers)
+
+        if cacheable:
+            headers.update({'ETag': page.etag,
+                            'Expires': formatdate(time.time() + self.expires, usegmt=True),
+                            'X-Pages': str(page.pages)})
+            if request.headers.get('If-None-Match') == page.etag:
+                self._count(route, 304, 0)
+                return web.Response(status=304, headers=headers)
+        self._count(route, 200, len(page.body))
+        return web.Response(body=page.body, content_type='application/json', headers=headers)
+
+    @staticmethod
+    def _page(pages, request):
+        page = int(request.query.get('page', 1))
+        return pages[page - 1] if pages is not None and 0 < page <= len(pages) else None
+
+    async def region_orders(self, request):
+        books = self.region_books.get(int(request.match_info['region_id']))
+        pages = books.get(request.query.get('order_type', 'all')) if books else None
+        return await self._respond(request, 'region_orders', self._page(pages, request))
+
+    async def history(self, request):
+        histories = self.history_pages.get(int(request.match_info['region_id']), {})
+        page = histories.get(int(request.query.get('type_id', 0)))
+        return await self._respond(request, 'history', page)
+
+    async def structure_orders(self, request):
+        pages = self.structure_books.get(int(request.match_info['structure_id']))
+        return await self._respond(request, 'structure_orders', self._page(pages, request))
+
+    async def structure(self, request):
+        page = self.structure_pages.get(int(request.match_info['structure_id']))
+        return await self._respond(request, 'structure', page)
+
+    async def character_orders(self, request):
+        page = self.character_books.get(int(request.match_info['character_id']), Page([]))
+        return await self._respond(request, 'character_orders', page)
+
+    async def wallet(self, request):
+        return await self._respond(request, 'wallet', Page(1000000000.0))
+
+    async def jwks_keys(self, request):
+        return await self._respond(request, 'jwks', self.jwks, cacheable=False)
+
+    async def token(self, request):
+        form = await request.post()
+        # refresh tokens of the benchmark are the character id, base64 encoded
+        character_id = base64.b64decode(form['refresh_token']).decode()
+        access_token = jwt.encode({'sub': 'CHARACTER:EVE:{}'.format(character_id),
+                                   'name': 'Character {}'.format(character_id),
+                                   'owner': 'owner{}'.format(character_id),
+                                   'iss': 'login.eveonline.com',
+                                   'exp': int(time.time()) + 1199},
+                                  self.private_key, algorithm='RS256', headers={'kid': SSO_KID})
+        page = Page({'access_token': access_token, 'expires_in': 1199, 'token_type': 'Bearer',
+                     'refresh_token': form['refresh_token']})
+        return await self._respond(request, 'token', page, cacheable=False)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/latest/markets/{region_id:\\d+}/orders/', self.region_orders)
+        app.router.add_get('/latest/markets/{region_id:\\d+}/history/', self.history)
+        app.router.add_get('/latest/markets/structures/{structure_id}/', self.structure_orders)
+        app.router.add_get('/latest/universe/structures/{structure_id}/', self.structure)
+        app.router.add_get('/latest/characters/{character_id}/orders/', self.character_orders)
+        app.router.add_get('/latest/characters/{character_id}/wallet/', self.wallet)
+        app.router.add_get('/oauth/jwks', self.jwks_keys)
+        app.router.add_post('/v2/oauth/token', self.token)
+        return app
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve from a daemon thread. Returns the base url.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, host, port)
+        self._loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        threading.Thread(target=self._loop.run_forever, daemon=True, name='esi-stub').start()
+        self.url = 'http://{}:{}'.format(host, port)
+        return self.url
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--expires', type=int, default=300)
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      page_size=args.page_size, expires=args.expires)
+    print('Serving fixtures on {}, Ctrl-C to stop.'.format(stub.start(args.host, args.port)))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
-from evelogi.utils import eve_oauth_url
+from evelogi.utils import eve_oauth_url, ESIResponseCache, init_redis, redis_pool_stats
 import os
+import glob
+import time
 import logging
+import threading
 import uuid
 
 from logging.handlers import RotatingFileHandler
@@ -10,19 +13,28 @@ import click
 from flask import Flask, session, abort
 from flask.helpers import url_for
 from flask.logging import default_handler
+from sqlalchemy import inspect
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from evelogi.extensions import db, migrate, login_manager, cache, Base, csrf, toolbar
+from evelogi.extensions import db, migrate, login_manager, cache, csrf, toolbar, esi, metrics
 from evelogi.settings import config
 from evelogi.blueprints.account import account_bp
 from evelogi.blueprints.main import main_bp
 from evelogi.blueprints.trade import trade_bp
-from evelogi.models.account import User, Character_, Role, Guest
+from evelogi.models.account import User, Character_, Role, Guest, permission_table
+from evelogi.market import refresh_jita_lowest_prices
+from evelogi.sde import StaticData, load_dump
+from evelogi.jobs import job_queue
+from evelogi.candidates import materialize_all
+from evelogi.metrics import cache_usage
 
 def create_app():
     config_name = os.getenv('FLASK_CONFIG', 'development')
 
     app = Flask('evelogi')
     app.config.from_object(config[config_name])
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 
     if app.config['SECRET_KEY'] is None:
         abort(400)
@@ -59,13 +71,14 @@ def register_logger(app):
 
 def register_extensions(app):
     db.init_app(app)
-    with app.app_context():
-        Base.prepare(db.engine, reflect=True)
     migrate.init_app(app, db)
     login_manager.init_app(app)
     login_manager.anonymous_user = Guest
+    init_redis(app)
     cache.init_app(app)
     csrf.init_app(app)
+    metrics.init_app(app)
+    esi.init_app(app, response_cache=ESIResponseCache())
     # toolbar.init_app(app)
 
 def register_blueprints(app):
@@ -115,4 +128,157 @@ def register_commands(app):
     def init():
         click.echo("Initializing the roles and permissions...")
         Role.init_role()
-        click.echo("Done.")
\ No newline at end of file
+        click.echo("Done.")
+
+    @app.cli.command('set-role')
+    @click.argument('character_name')
+    @click.argument('role_name')
+    def set_role(character_name, role_name):
+        """Change the role of the user owning a character."""
+        character = Character_.query.filter_by(name=character_name).first()
+        if character is None or character.user is None:
+            raise click.ClickException('No user owns {}.'.format(character_name))
+        if Role.query.filter_by(name=role_name).first() is None:
+            raise click.ClickException('No role named {}.'.format(role_name))
+        character.user.set_role(role_name)
+        click.echo('{} is now {}.'.format(character_name, role_name))
+
+    @app.cli.command('invalidate-permissions')
+    def invalidate_permissions():
+        """Make every worker reload roles and permissions, after editing them in the database."""
+        permission_table.invalidate()
+        click.echo('Invalidated the permission table.')
+
+    @app.cli.command('redis-stats')
+    def redis_stats():
+        """Show the connection usage of the Redis pools."""
+        for name, stats in redis_pool_stats().items():
+            click.echo('{}: {}'.format(name, ', '.join('{} {}'.format(k, v) for k, v in stats.items())))
+
+    @app.cli.command('cache-stats')
+    @click.option('--no-usage', is_flag=True, help='Skip scanning Redis for key counts and sizes.')
+    @click.option('--full', is_flag=True, help='Scan every Redis key for exact key counts.')
+    @click.option('--reset', is_flag=True, help='Reset the hit and miss counts afterwards.')
+    def cache_stats(no_usage, full, reset):
+        """Show hit, miss and stale counts and sizes per cache namespace."""
+        stats = metrics.cache_stats()
+        usage, server = ({}, {}) if no_usage else cache_usage(app.config['CACHE_STATS_SAMPLE'], full)
+        click.echo('{:<22} {:>10} {:>10} {:>10} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'namespace', 'hits', 'misses', 'stale', 'ratio', 'writes', 'read MiB', 'write MiB',
+            'keys', 'size MiB', 'mean TTL'))
+        for namespace, counts in stats.items():
+            keys = usage.get(namespace)
+            click.echo('{:<22} {:>10.0f} {:>10.0f} {:>10.0f} {:>7} {:>10.0f} {:>9.1f} {:>9.1f} {:>9} {:>9} {:>9}'.format(
+                namespace, counts['hit'], counts['miss'], counts['stale'],
+                '{:.1%}'.format(counts['hit_ratio']) if counts['hit_ratio'] is not None else '-',
+                counts['write'], (counts['hit_bytes'] + counts['stale_bytes']) / 2 ** 20,
+                counts['write_bytes'] / 2 ** 20,
+                '{}{}'.format('~' if keys['estimated'] else '', keys['keys']) if keys else '-',
+                '{:.1f}'.format(keys['bytes'] / 2 ** 20) if keys else '-',
+                '{:.0f}s'.format(keys['mean_ttl']) if keys and keys['mean_ttl'] is not None else '-'))
+        for name, value in server.items():
+            click.echo('{}: {}'.format(name, value))
+        if reset:
+            metrics.reset_cache_stats()
+            click.echo('Reset the cache counts.')
+
+    @app.cli.group()
+    def sde():
+        """Static data export commands."""
+
+    @sde.command()
+    def build():
+        """Build the SDE lookup artifact read by the workers."""
+        static_data = StaticData.from_db()
+        static_data.save(app.config['SDE_PATH'])
+        click.echo('Saved {} types and {} solar systems to {}.'.format(
+            len(static_data.types), len(static_data.solar_system_ids), app.config['SDE_PATH']))
+
+    @sde.command()
+    @click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', default=10000, help='Rows per insert batch.')
+    @click.option('--no-build', is_flag=True, help='Do not rebuild the lookup artifact.')
+    def load(paths, batch_size, no_build):
+        """Bulk load SDE dumps (.sql or .csv, optionally .bz2 or .gz), the ones in sql/ by default."""
+        paths = paths or sorted(glob.glob(os.path.join(os.path.dirname(app.root_path), 'sql', '*.sql')))
+        for path in paths:
+            start = time.time()
+            for table, count in load_dump(path, batch_size).items():
+                click.echo('Loaded {} rows into {} in {:.1f}s.'.format(count, table, time.time() - start))
+        if no_build:
+            return
+        missing = [table for table in ('invTypes', 'invVolumes', 'mapSolarSystems')
+                   if not inspect(db.engine).has_table(table)]
+        if missing:
+            click.echo('Skipped the lookup artifact, load {} first.'.format(', '.join(missing)))
+            return
+        build.callback()
+
+    @app.cli.group()
+    def jobs():
+        """Background job commands."""
+
+    @jobs.command()
+    @click.option('--workers', default=4, help='Number of worker threads.')
+    def work(workers):
+        """Run queued jobs until interrupted."""
+        stop = threading.Event()
+        threads = [threading.Thread(target=job_queue.work, args=(app, stop), name='job-worker-{}'.format(i))
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        click.echo('Running {} job workers.'.format(workers))
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            click.echo('Stopping after the running jobs.')
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    @app.cli.command()
+    @click.option('--interval', type=int, help='Seconds between refreshes.')
+    @click.option('--once', is_flag=True, help='Refresh once and exit.')
+    def materialize(interval, once):
+        """Refresh the trade candidates of every structure on a schedule."""
+        interval = interval or app.config['MATERIALIZE_INTERVAL']
+        while True:
+            start = time.time()
+            try:
+                refreshed, failed = materialize_all()
+            except Exception as e:
+                # a Redis or ESI blip must not stop the scheduler, try again next interval
+                app.logger.exception('Materialize failed: {}'.format(e))
+                click.echo('Materialize failed: {}'.format(e))
+            else:
+                click.echo('Materialized {} structures, {} failed.'.format(len(refreshed), len(failed)))
+            # let the next round see rows committed by other workers
+            db.session.remove()
+            if once:
+                break
+            time.sleep(max(interval - (time.time() - start), 0))
+
+    @app.cli.command('ingest-jita')
+    @click.option('--interval', type=int, help='Seconds between refreshes.')
+    @click.option('--once', is_flag=True, help='Refresh once and exit.')
+    def ingest_jita(interval, once):
+        """Refresh the Jita lowest price snapshot on a schedule."""
+        interval = interval or app.config['JITA_INGEST_INTERVAL']
+        while True:
+            start = time.time()
+            try:
+                snapshot = refresh_jita_lowest_prices()
+            except Exception as e:
+                # a Redis or ESI blip must not stop the ingester, try again next interval
+                app.logger.exception('Jita ingest failed: {}'.format(e))
+                click.echo('Jita ingest failed: {}'.format(e))
+            else:
+                if snapshot is None:
+                    click.echo('Another ingest is running, skipped.')
+                else:
+                    click.echo('Published Jita snapshot {}, {} types.'.format(
+                        snapshot['version'], len(snapshot['data'])))
+            if once:
+                break
+            time.sleep(max(interval - (time.time() - start), 0))
\ No newline at end of file
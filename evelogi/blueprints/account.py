@@ -1,6 +1,7 @@
 import os
 import base64
 import requests
+from urllib.parse import urlparse
 
 from flask import Blueprint, flash, session
 from flask.templating import render_template
@@ -40,15 +41,21 @@ def login():
 
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
-        "Host": "login.eveonline.com",
+        "Host": urlparse(current_app.config['SSO_TOKEN_URL']).netloc,
         "Authorization": auth_header
     }
 
-    res = requests.post(
-        "https://login.eveonline.com/v2/oauth/token",
-        data=form_values,
-        headers=headers,
-    )
+    try:
+        res = requests.post(
+            current_app.config['SSO_TOKEN_URL'],
+            data=form_values,
+            headers=headers,
+            timeout=current_app.config.get('SSO_TIMEOUT', 10),
+        )
+    except requests.RequestException as e:
+        current_app.logger.warning('SSO token request failed: {}'.format(e))
+        flash('EVE SSO is not responding, please try again.')
+        return redirect_back()
 
     if res.status_code == 200:
         data = res.json()
@@ -129,6 +136,7 @@ def login():
 @login_required
 def logout():
     logout_user()
+    session.pop('role', None)
     return redirect(url_for('main.index'))
 
 
@@ -184,7 +192,7 @@ def add_structure():
                               character=character
                               )
         try:
-            structure.get_structure_data('name')
+            structure.check_access()
         except GetESIDataError as e:
             current_app.logger.debug(e)
             flash('Add structure failed, Check structure id or access control.')
@@ -225,10 +233,11 @@ def edit_structure(id):
         structure.to_jita_collateral = form.to_jita_collateral.data
         structure.sales_tax = form.sales_tax.data
         structure.brokers_fee = form.brokers_fee.data
-        structure.character_id = form.character_id.data
+        # the relationship, the access check below uses this character's token
+        structure.character = Character_.query.get_or_404(form.character_id.data)
 
         try:
-            structure.get_structure_data('name')
+            structure.check_access()
         except GetESIDataError as e:
             form.structure_id.data = former_structure_id
             flash('Edit structure failed, Check structure id or access control.')
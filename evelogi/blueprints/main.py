@@ -1,9 +1,11 @@
 from flask import Blueprint
-from flask import render_template
+from flask import render_template, current_app
 
 from flask_login import login_required, current_user
 
 from evelogi.models.account import Structure
+from evelogi.utils import permission_required
+from evelogi.metrics import metrics, cache_usage
 
 main_bp = Blueprint('main', __name__) 
 
@@ -16,4 +18,14 @@ def index():
 def account():
     structures = [
         structure for character in current_user.characters for structure in character.structures]
-    return render_template('main/account.html', structures=structures)
+    results, errors = current_user.fan_out('/characters/{}/orders/', '/characters/{}/wallet/')
+    return render_template('main/account.html', structures=structures,
+                           orders=results['/characters/{}/orders/'],
+                           wallets=results['/characters/{}/wallet/'], errors=errors)
+
+@main_bp.route('/admin/cache')
+@login_required
+@permission_required('ADMIN')
+def cache_stats():
+    usage, server = cache_usage(current_app.config['CACHE_STATS_SAMPLE'])
+    return render_template('main/cache.html', stats=metrics.cache_stats(), usage=usage, server=server)
@@ -0,0 +1,334 @@
+import time
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import current_app
+
+from evelogi.utils import async_get_esi_data, flight_lock, release_flight_lock
+from evelogi.extensions import db, esi
+from evelogi.esi import FetchScheduler
+from evelogi.models.account import Structure
+from evelogi.models.trade import MarketHistory, MonthVolume, window_volume
+from evelogi.market import get_jita_lowest_prices, publish_snapshot, load_snapshot
+from evelogi.orderbook import refresh_order_books
+from evelogi.scoring import score_opportunities
+from evelogi.sde import get_static_data
+from evelogi.jobs import job_queue
+from evelogi.metrics import metrics
+from evelogi.exceptions import GetESIDataNotFound
+
+
+def candidates_name(structure_id):
+    return 'structure_candidates_{}'.format(structure_id)
+
+
+def candidates_inputs(structure):
+    """Settings of a structure its candidate table is scored with.
+    """
+    return [structure.structure_id, structure.character_id, structure.jita_to_fee,
+            structure.sales_tax, structure.brokers_fee]
+
+
+def load_candidates(structure, max_age=None):
+    """Latest candidate table of a structure, None until it is materialized
+    with the current settings of the structure. A table scored before the
+    structure was edited counts as missing.
+    """
+    snapshot = load_snapshot(candidates_name(structure.id), max_age)
+    if snapshot is not None and snapshot['data'].get('inputs') != candidates_inputs(structure):
+        return None
+    return snapshot
+
+
+def materialize_structures(structures, progress=None):
+    """Score every Jita to structure opportunity of many structures in one pass
+    and publish a table per structure, without the margin and volume filters
+    of the trade form, which are applied per request by `filter_candidates`.
+
+    The Jita price index and type metadata are built once, structure orders
+    are fetched concurrently and so is the history of every region. Types
+    the owner of a structure already sells are left out of its table.
+    Returns
+        (snapshots, failed): snapshots maps structure id to its published
+        table, failed maps structure id to the error that stopped it.
+        Both are empty if the Jita snapshot is not ready.
+    """
+    progress = progress or (lambda message: None)
+    snapshots, failed = {}, {}
+    jita_snapshot = get_jita_lowest_prices()
+    if jita_snapshot is None:
+        return snapshots, failed
+    jita_lowest_price = jita_snapshot['data']
+    type_ids = np.fromiter(jita_lowest_price, dtype=np.int64, count=len(jita_lowest_price))
+    jita_prices = np.fromiter(jita_lowest_price.values(), dtype=np.float64, count=len(jita_lowest_price))
+    static_data = get_static_data()
+    packaged_volumes = static_data.types.bulk_packaged_volumes(type_ids)
+
+    progress('Fetching personal orders.')
+    sold, messages = {}, {}
+    for user in {structure.character.user for structure in structures}:
+        with metrics.stage('personal_orders'):
+            my_orders, errors = user.get_orders(columnar=True)
+        messages[user.id] = ["Failed to fetch orders of {}.".format(
+            ', '.join(character.name for character in errors))] if errors else []
+        sold[user.id] = np.isin(type_ids, my_orders.sells()['type_id'])
+
+    progress('Fetching structure orders.')
+    regions = {}
+    for structure in structures:
+        try:
+            regions[structure.id] = static_data.region_id(
+                structure.get_structure_data('solar_system_id'))
+        except Exception as e:
+            # a failed query would leave the session unusable for the next structures
+            db.session.rollback()
+            failed[structure.id] = e
+
+    with metrics.stage('structure_orders'):
+        books = refresh_order_books([structure for structure in structures if structure.id in regions])
+    if any(isinstance(book, Exception) for book in books.values()):
+        db.session.rollback()
+    local_prices = {structure_id: book if isinstance(book, Exception) else dict(book['data']['lowest'])
+                    for structure_id, book in books.items()}
+
+    progress('Reading month volumes.')
+    wanted = {}
+    for structure in structures:
+        if structure.id in regions:
+            keep = ~sold[structure.character.user_id]
+            wanted[regions[structure.id]] = wanted.get(regions[structure.id], keep) | keep
+    volumes = get_regions_month_volumes(
+        {region_id: type_ids[keep].tolist() for region_id, keep in wanted.items()}, progress)
+
+    progress('Scoring.')
+    for structure in structures:
+        if structure.id in failed:
+            continue
+        if isinstance(local_prices[structure.id], Exception):
+            failed[structure.id] = local_prices[structure.id]
+            continue
+        region_volumes = volumes[regions[structure.id]]
+        if isinstance(region_volumes, Exception):
+            failed[structure.id] = region_volumes
+            continue
+        try:
+            snapshots[structure.id] = publish_candidates(
+                structure, region_volumes, type_ids, jita_prices, packaged_volumes,
+                local_prices[structure.id], sold[structure.character.user_id],
+                messages[structure.character.user_id], jita_snapshot, static_data)
+        except Exception as e:
+            db.session.rollback()
+            failed[structure.id] = e
+
+    for structure_id, error in failed.items():
+        current_app.logger.warning('structure: {}, materialize failed: {}'.format(structure_id, error))
+    return snapshots, failed
+
+
+def publish_candidates(structure, region_volumes, type_ids, jita_prices, packaged_volumes,
+                       local_lowest_price, sold, messages, jita_snapshot, static_data):
+    """Score and publish the candidate table of one structure, see
+    `materialize_structures`. Returns the published snapshot.
+    """
+    region_volumes, fails = region_volumes
+    month_volumes = np.array([region_volumes.get(type_id, 0) for type_id in type_ids.tolist()],
+                             dtype=np.float64)
+    keep = ~sold & (month_volumes != 0)
+    with metrics.stage('scoring'):
+        result = score_opportunities(
+            type_ids[keep],
+            jita_prices[keep],
+            [local_lowest_price.get(type_id, float('nan')) for type_id in type_ids[keep].tolist()],
+            month_volumes[keep],
+            packaged_volumes[keep],
+            jita_to_fee=structure.jita_to_fee,
+            sales_tax=structure.sales_tax,
+            brokers_fee=structure.brokers_fee,
+            margin_filter=float('-inf'),
+            volume_filter=0)
+        table = {name: values.tolist() for name, values in result.items()}
+        table['type_name'] = static_data.types.bulk_names(result['type_id'])
+    messages = list(messages)
+    if fails > 0:
+        messages.append("{} fails when fetching data.".format(fails))
+    current_app.logger.info('structure: {}, {} candidates materialized.'.format(
+        structure.id, len(table['type_id'])))
+    return publish_snapshot(candidates_name(structure.id), {
+        'table': table,
+        'messages': messages,
+        'materialized_at': time.time(),
+        'jita_updated_at': jita_snapshot['updated_at'],
+        'inputs': candidates_inputs(structure),
+    })
+
+
+def materialize_locked(structures, progress=None, wait=False):
+    """`materialize_structures` holding the lock of every structure. Structures
+    another worker is materializing are skipped, or waited for with `wait`.
+    Locks are taken in structure id order, so two jobs waiting for each other's
+    structures can't deadlock. Returns (snapshots, failed) like `materialize_structures`.
+    """
+    timeout = current_app.config.get('JOB_TIMEOUT', 900)
+    locks, timed_out = [], {}
+    try:
+        for structure in sorted(structures, key=lambda structure: structure.id):
+            lock = flight_lock(candidates_name(structure.id), timeout=timeout)
+            if lock.acquire(blocking=wait, blocking_timeout=timeout if wait else None):
+                locks.append((structure, lock))
+            elif wait:
+                timed_out[structure.id] = TimeoutError('Timed out waiting for {}'.format(structure.id))
+        snapshots, failed = materialize_structures([structure for structure, lock in locks], progress)
+        failed.update(timed_out)
+        return snapshots, failed
+    finally:
+        for structure, lock in locks:
+            release_flight_lock(lock)
+
+
+@job_queue.handler('materialize')
+def materialize_job(user_id, progress, structure_ids):
+    structures = Structure.query.filter(Structure.id.in_(structure_ids)).all()
+    if len(structures) != len(structure_ids) or \
+            any(structure.character.user_id != user_id for structure in structures):
+        raise ValueError('Unknown structures {}'.format(structure_ids))
+    if get_jita_lowest_prices() is None:
+        raise ValueError('Jita market data is not ready yet, please try again later.')
+    snapshots, failed = materialize_locked(structures, progress, wait=True)
+    if failed:
+        raise ValueError('Failed to materialize {}.'.format(', '.join(
+            structure.name for structure in structures if structure.id in failed)))
+    return {'versions': {structure_id: snapshot['version'] for structure_id, snapshot in snapshots.items()}}
+
+
+def materialize_all():
+    """Refresh the candidate table of every structure in one pass, skipping the
+    ones another worker is refreshing. Returns (refreshed, failed) structure ids.
+    """
+    snapshots, failed = materialize_locked(Structure.query.all())
+    return list(snapshots), list(failed)
+
+
+def get_regions_month_volumes(type_ids, progress=None):
+    """`get_month_volumes` of many regions at once.
+
+    Args:
+        type_ids: maps region id to the type ids wanted in that region.
+    Returns
+        dict: maps region id to (volumes, fails) or to the raised exception.
+    """
+    app = current_app._get_current_object()
+    reported = [0]
+    history_progress = None
+    if progress is not None:
+        def history_progress(done, total, failed, rate):
+            # every finished item calls this, report at most once a second
+            if time.monotonic() - reported[0] > 1 or done == total:
+                reported[0] = time.monotonic()
+                progress('Fetching market history {}/{}, {:.1f}/s.'.format(done, total, rate))
+
+    def task(region_id):
+        try:
+            return get_month_volumes(type_ids[region_id], region_id, history_progress)
+        except Exception as e:
+            db.session.rollback()
+            return e
+
+    def thread_task(region_id):
+        with app.app_context():
+            return task(region_id)
+
+    if len(type_ids) == 1:
+        # the caller's app context, a pushed one would remove the caller's
+        # session on teardown and detach its structures
+        return {region_id: task(region_id) for region_id in type_ids}
+    with ThreadPoolExecutor(max_workers=len(type_ids), thread_name_prefix='region-history') as executor:
+        return dict(zip(type_ids, executor.map(thread_task, type_ids)))
+
+
+def get_month_volumes(type_ids, region_id, progress=None):
+    """Month volumes of types in a region. Read from the MonthVolume table in one
+    query, types updated more than HISTORY_VOLUME_UPDATE_INTERVAL days ago get
+    their new days of history from ESI. Returns (volumes, fails).
+    `progress` is passed on to the FetchScheduler.
+
+    Fetches for a region are coalesced, a caller that finds one in flight
+    waits for it and then only fetches what is still missing. A caller that
+    gives up waiting sums full histories without storing them, so it never
+    writes the same rows as the flight.
+    """
+    interval = timedelta(days=current_app.config.get('HISTORY_VOLUME_UPDATE_INTERVAL', 7))
+    today = date.today()
+
+    def read_stored(type_ids, count_lookups=False):
+        to_get = []
+        stale = 0
+        stored = MonthVolume.region_volumes(region_id)
+        for type_id in type_ids:
+            month_volume = stored.get(type_id)
+            if month_volume is None or today - month_volume.update_time >= interval:
+                to_get.append(type_id)
+                stale += month_volume is not None
+            else:
+                volumes[type_id] = month_volume.volume
+        if count_lookups:
+            metrics.cache('month_volume', 'hit', count=len(type_ids) - len(to_get))
+            metrics.cache('month_volume', 'stale', count=stale)
+            metrics.cache('month_volume', 'miss', count=len(to_get) - stale)
+        return to_get
+
+    volumes = {}
+    with metrics.stage('volume_lookup'):
+        to_get = read_stored(type_ids, count_lookups=True)
+    if not to_get:
+        return volumes, 0
+
+    lock = flight_lock('month_volume_{}'.format(region_id))
+    acquired = lock.acquire(
+        blocking_timeout=current_app.config.get('SINGLE_FLIGHT_WAIT', 60))
+    try:
+        # end the transaction so rows committed by the flight we waited on are visible
+        db.session.commit()
+        with metrics.stage('volume_lookup'):
+            to_get = read_stored(to_get)
+        current_app.logger.info('{} need to fetch.'.format(len(to_get)))
+        if not acquired:
+            current_app.logger.warning('month volume flight of region {} still running, '
+                                       'not storing {} types'.format(region_id, len(to_get)))
+            with metrics.stage('history_fetch'):
+                histories, fails = esi.run(get_region_history(to_get, region_id, {}, progress))
+            window_start = today - timedelta(days=30)
+            volumes.update({type_id: window_volume(days, window_start) for type_id, days in histories.items()})
+            return volumes, fails
+        with metrics.stage('history_fetch'):
+            histories, fails = esi.run(get_region_history(
+                to_get, region_id, MarketHistory.last_dates(region_id), progress))
+        volumes.update(MonthVolume.append_history(region_id, histories, today))
+    finally:
+        if acquired:
+            release_flight_lock(lock)
+    return volumes, fails
+
+
+async def get_region_history(type_ids, region_id, last_dates, progress=None):
+    """Fetch the days of history newer than `last_dates` of types in a region.
+    Runs on the shared ESI client loop. Returns (histories, fails).
+    """
+    scheduler = FetchScheduler(esi, progress=progress)
+    histories, failed = await scheduler.run(
+        type_ids, lambda type_id: get_item_history(type_id, region_id, last_dates.get(type_id)))
+    return histories, len(failed)
+
+
+async def get_item_history(type_id, region_id, last_date):
+    """Days of history of a type newer than `last_date`. Types without history
+    have none, other errors are raised so the scheduler can retry.
+    """
+    path = esi.url('/markets/{}/history/'.format(region_id), type_id=type_id)
+    try:
+        data = await async_get_esi_data(path)
+    except GetESIDataNotFound:
+        return []
+    # iso dates compare in date order
+    since = last_date.isoformat() if last_date is not None else ''
+    return [day for day in data if day['date'] > since]
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+
+import aiohttp
+
+from evelogi.exceptions import GetESIDataError, GetESIDataClientError, GetESIDataNotFound
+from evelogi.metrics import metrics, esi_endpoint
+
+
+class ESIClient:
+    """Long-lived ESI client shared by every request of a worker process.
+
+    One aiohttp session lives on a background event loop, so connections to
+    ESI are kept alive and reused instead of paying a new TCP and TLS
+    handshake on every call. Synchronous code submits coroutines with `run`.
+    """
+
+    def __init__(self, app=None, response_cache=None):
+        self.app = None
+        self.response_cache = None
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._error_limit_remain = None
+        self._error_limit_reset = 0
+        self._fetch_bucket = None
+        if app is not None:
+            self.init_app(app, response_cache)
+
+    def init_app(self, app, response_cache=None):
+        # the ESI_* settings and their defaults live in BaseConfig
+        self.app = app
+        if app.config['ESI_RESPONSE_CACHE_ENABLED']:
+            self.response_cache = response_cache
+        app.extensions['esi'] = self
+
+    def url(self, path, **params):
+        """Build an ESI url from a path such as '/markets/10000002/orders/'.
+        """
+        params.setdefault('datasource', self.app.config['ESI_DATASOURCE'])
+        return '{}{}?{}'.format(self.app.config['ESI_BASE_URL'], path, urlencode(params))
+
+    def _get_loop(self):
+        with self._lock:
+            # a forked worker inherits the loop object but not its thread
+            if self._loop is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._session = None
+                self._fetch_bucket = None
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name='esi-client', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """Run a coroutine on the client loop and wait for its result.
+        Must not be called from a coroutine running on that loop.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._with_app_context(coro), self._get_loop())
+        return future.result()
+
+    async def _with_app_context(self, coro):
+        with self.app.app_context():
+            return await coro
+
+    async def blocking(self, func, *args):
+        """Run a blocking call, such as a Redis round trip of the response
+        cache, in the loop's executor within the app context, so it does not
+        stall the other requests on the loop.
+        """
+        def call():
+            with self.app.app_context():
+                return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    async def session(self):
+        if self._session is None or self._session.closed:
+            config = self.app.config
+            connector = aiohttp.TCPConnector(
+                limit=config['ESI_CONNECTION_LIMIT'],
+                limit_per_host=config['ESI_CONNECTION_LIMIT_PER_HOST'],
+                keepalive_timeout=config['ESI_KEEPALIVE_TIMEOUT'],
+                ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=config['ESI_TIMEOUT']),
+                headers={'User-Agent': config['ESI_USER_AGENT']})
+        return self._session
+
+    async def get_json(self, path):
+        """Fetch one ESI page. Returns (data, headers).
+
+        Responses are served from the response cache until they expire and
+        then revalidated with their ETag, authenticated ones only to the
+        character that fetched them. Server errors, timeouts and error
+        limited (420) responses are retried with exponential backoff, or after
+        `Retry-After` when ESI sends it. Other client errors are raised
+        immediately since retrying them will not help.
+        """
+        cache = self.response_cache
+        entry = await self.blocking(cache.get, path) if cache is not None else None
+        if entry is not None and cache.is_fresh(entry):
+            return entry['data'], entry['headers']
+
+        request_headers = {}
+        if entry is not None and entry['etag']:
+            request_headers['If-None-Match'] = entry['etag']
+
+        session = await self.session()
+        endpoint = esi_endpoint(path)
+        retries = self.app.config['ESI_RETRIES']
+        headers = None
+        for i in range(retries):
+            if i:
+                await asyncio.sleep(self._retry_delay(i, headers))
+                headers = None
+            await self.wait_error_limit()
+            try:
+                async with session.get(path, headers=request_headers) as resp:
+                    status = resp.status
+                    headers = resp.headers
+                    self._track_error_limit(headers)
+                    if status == 304:
+                        result = None
+                    else:
+                        body = await resp.read()
+                        metrics.inc('evelogi_esi_response_bytes_total', len(body), endpoint=endpoint)
+                        result = json.loads(body) if body else None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                metrics.inc('evelogi_esi_requests_total', endpoint=endpoint, status='error')
+                self.app.logger.warning(
+                    'ESI request failed: {}, attempt: {}'.format(repr(e), i+1))
+                continue
+            metrics.inc('evelogi_esi_requests_total', endpoint=endpoint, status=status)
+
+            if status == 304 and entry is not None:
+                entry = await self.blocking(cache.refresh, path, entry, headers)
+                return entry['data'], entry['headers']
+            elif status == 200:
+                if cache is not None:
+                    await self.blocking(cache.set, path, result, headers)
+                return result, headers
+            elif status == 404:
+                raise GetESIDataNotFound(result)
+            elif 400 <= status < 500 and status != 420:
+                raise GetESIDataClientError(result)
+            else:
+                if status == 420:
+                    # error limited, hold every request until the window resets
+                    self._error_limit_remain = 0
+                self.app.logger.warning(
+                    "status: {} response: {}, attempt: {}".format(status, result, i+1))
+        raise GetESIDataError('ESI request failed after {} attempts'.format(retries))
+
+    def _retry_delay(self, attempt, headers=None):
+        """Seconds to wait before retry number `attempt`, the response's
+        Retry-After if it has one, else exponential backoff with jitter.
+        """
+        config = self.app.config
+        retry_after = headers.get('Retry-After') if headers is not None else None
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0), config['ESI_BACKOFF_MAX'])
+        delay = min(config['ESI_BACKOFF_BASE'] * 2 ** (attempt - 1), config['ESI_BACKOFF_MAX'])
+        return random.uniform(delay / 2, delay)
+
+    def fetch_bucket(self):
+        """The ESI_FETCH_RATE bucket every FetchScheduler of the process shares,
+        so schedulers running side by side, one per region or job, don't add
+        up their rates. Used on the client loop only.
+        """
+        if self._fetch_bucket is None:
+            self._fetch_bucket = TokenBucket(self.app.config['ESI_FETCH_RATE'])
+        return self._fetch_bucket
+
+    def _track_error_limit(self, headers):
+        remain = headers.get('X-ESI-Error-Limit-Remain')
+        reset = headers.get('X-ESI-Error-Limit-Reset')
+        if remain is not None and reset is not None:
+            self._error_limit_remain = int(remain)
+            self._error_limit_reset = time.monotonic() + int(reset)
+
+    async def wait_error_limit(self):
+        """Pause while the ESI error limit is nearly used up, until its window resets.
+        """
+        if self._error_limit_remain is None or \
+                self._error_limit_remain > self.app.config['ESI_ERROR_LIMIT_THRESHOLD']:
+            return
+        delay = self._error_limit_reset - time.monotonic()
+        if delay > 0:
+            self.app.logger.warning('ESI error limit remain {}, pausing {:.0f}s'.format(
+                self._error_limit_remain, delay))
+            await asyncio.sleep(delay)
+        self._error_limit_remain = None
+
+    async def get_pages(self, path):
+        """Fetch every page of a paginated endpoint concurrently.
+        """
+        data, headers = await self.get_json(path)
+        pages = int(headers.get('X-Pages', 1))
+        if pages > 1:
+            results = await asyncio.gather(
+                *[self.get_json(path + '&page={}'.format(i)) for i in range(2, pages + 1)])
+            for result, _ in results:
+                data += result
+        return data
+
+    async def map_pages(self, path, func):
+        """Apply `func` to every page of a paginated endpoint as it arrives and
+        drop the decoded page. `func` runs in the executor, off the event loop.
+        Returns the results in page order.
+        """
+        data, headers = await self.get_json(path)
+        pages = int(headers.get('X-Pages', 1))
+        results = [await self.blocking(func, data)] + [None] * (pages - 1)
+        del data
+
+        async def fetch(page):
+            data, _ = await self.get_json(path + '&page={}'.format(page))
+            return page, data
+
+        tasks = [asyncio.ensure_future(fetch(i)) for i in range(2, pages + 1)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                page, data = await task
+                results[page - 1] = await self.blocking(func, data)
+                del data
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return results
+
+    def get(self, path):
+        return self.run(self.get_pages(path))
+
+    def close(self):
+        if self._loop is not None and self._session is not None and self._pid == os.getpid():
+            asyncio.run_coroutine_threadsafe(
+                self._session.close(), self._loop).result()
+            self._session = None
+
+
+class TokenBucket:
+    """Token bucket limiting how often a coroutine may proceed.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchScheduler:
+    """Runs one fetch per item with bounded concurrency and a rate limit.
+
+    Items whose requests still fail after `ESIClient.get_json` retried them
+    are re-queued with exponential backoff instead of being dropped, up to
+    ESI_FETCH_MAX_ATTEMPTS, so an item costs at most ESI_RETRIES times
+    ESI_FETCH_MAX_ATTEMPTS requests. Client errors and any other exception
+    fail the item at once, retrying them would only spend the ESI error
+    limit. The rate limit is the one bucket of the client, see
+    `ESIClient.fetch_bucket`, unless `rate` asks for a separate one, and
+    requests also pause on the error limit the client tracks, see
+    `ESIClient.wait_error_limit`. Runs on the client loop.
+
+    Args:
+        progress: optional callable receiving (done, total, failed, rate)
+            as items finish.
+    """
+
+    def __init__(self, client, concurrency=None, rate=None, max_attempts=None, progress=None):
+        config = client.app.config
+        self.client = client
+        self.concurrency = concurrency or config['ESI_FETCH_CONCURRENCY']
+        self.bucket = TokenBucket(rate) if rate else client.fetch_bucket()
+        self.max_attempts = max_attempts or config['ESI_FETCH_MAX_ATTEMPTS']
+        self.progress = progress
+        self.errors = {}
+
+    async def run(self, items, fetch):
+        """Run `fetch(item)` for every item. Returns (results, failed) where
+        results maps item to result and failed lists the items that gave up.
+        The last error of every failed item is kept in `errors`.
+        """
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait((item, 1))
+        total = queue.qsize()
+        results = {}
+        failed = []
+        start = time.monotonic()
+        reported = start
+
+        async def worker():
+            nonlocal reported
+            while True:
+                item, attempt = await queue.get()
+                try:
+                    await self.bucket.acquire()
+                    try:
+                        results[item] = await fetch(item)
+                    except GetESIDataClientError as e:
+                        self.errors[item] = e
+                        failed.append(item)
+                    except GetESIDataError as e:
+                        self.errors[item] = e
+                        if attempt < self.max_attempts:
+                            # holding the worker while backing off lowers the pressure on ESI
+                            await asyncio.sleep(min(2 ** attempt, 60))
+                            queue.put_nowait((item, attempt + 1))
+                            continue
+                        self.client.app.logger.warning('giving up on {}: {}'.format(item, e))
+                        failed.append(item)
+                    except Exception as e:
+                        # a dead worker would leave queue.join() waiting forever
+                        self.client.app.logger.exception('fetching {} failed'.format(item))
+                        self.errors[item] = e
+                        failed.append(item)
+
+                    done = len(results) + len(failed)
+                    now = time.monotonic()
+                    rate = done / max(now - start, 1e-9)
+                    if self.progress is not None:
+                        try:
+                            self.progress(done, total, len(failed), rate)
+                        except Exception:
+                            self.client.app.logger.exception('fetch progress report failed')
+                    if now - reported > 10 or done == total:
+                        reported = now
+                        self.client.app.logger.info('fetched {}/{}, {} failed, {:.1f}/s'.format(
+                            done, total, len(failed), rate))
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self.concurrency, total))]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+        return results, failed
+
+
+esi = ESIClient()
@@ -1,8 +1,17 @@
 class GetESIDataError(Exception):
     pass
 
-class GetESIDataNotFound(GetESIDataError):
+class GetESIDataClientError(GetESIDataError):
+    pass
+
+class GetESIDataNotFound(GetESIDataClientError):
     pass
 
 class InvTypesNotFound(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class TokenRefreshError(Exception):
+    pass
+
+class SingleFlightTimeout(Exception):
+    pass
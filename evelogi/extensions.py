@@ -2,12 +2,13 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_caching import Cache
-from sqlalchemy.ext.automap import automap_base
 from flask_wtf.csrf import CSRFProtect
 from flask_debugtoolbar import DebugToolbarExtension
 
+from evelogi.esi import esi
+from evelogi.metrics import metrics
+
 db = SQLAlchemy()
-Base = automap_base()
 migrate = Migrate()
 login_manager = LoginManager()
 cache = Cache()
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+
+from flask import current_app
+
+from evelogi.utils import get_redis
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """Background jobs queued in Redis.
+
+    A job is a JSON record under `job_{id}` whose id is pushed on a Redis
+    list. Worker threads of any process pop ids, run the handler registered
+    for the job kind and keep the result in the record for
+    JOB_RESULT_TIMEOUT seconds. Submitting a job identical to a queued or
+    running one of the same user returns the id of that job instead.
+
+    Popped ids move to a processing list of the worker in the same step and
+    live workers keep a heartbeat key alive. The jobs of a worker whose
+    heartbeat expired, killed or restarted mid-job, are queued again, up to
+    JOB_MAX_ATTEMPTS runs, and fail after that.
+    """
+    queue_key = 'job_queue'
+    key_str = 'job_{}'
+    dedup_str = 'job_dedup_{}'
+    # hash tagged like the queue, a job moves between them in one command
+    workers_key = '{job_queue}_workers'
+    processing_str = '{{job_queue}}_processing_{}'
+    heartbeat_str = '{{job_queue}}_heartbeat_{}'
+
+    def __init__(self):
+        self.handlers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def handler(self, kind):
+        """Register the function running jobs of a kind. It is called with
+        the user id, a `progress(message)` callable and the job args, and
+        returns a JSON serializable result.
+        """
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+
+    def get(self, job_id):
+        job = get_redis().get(self.key_str.format(job_id))
+        return json.loads(job) if job is not None else None
+
+    def save(self, job):
+        get_redis().set(self.key_str.format(job['id']), json.dumps(job),
+                        ex=current_app.config.get('JOB_RESULT_TIMEOUT', 3600))
+
+    def enqueue(self, kind, user_id, args):
+        """Queue a job and return its id.
+        """
+        r = get_redis()
+        digest = hashlib.sha1(json.dumps([kind, user_id, args], sort_keys=True).encode()).hexdigest()
+        dedup_key = self.dedup_str.format(digest)
+        job_id = uuid.uuid4().hex
+        timeout = current_app.config.get('JOB_TIMEOUT', 900)
+        if not r.set(dedup_key, job_id, nx=True, ex=timeout):
+            existing = r.get(dedup_key)
+            job = self.get(existing) if existing is not None else None
+            if job is not None and job['status'] in (QUEUED, RUNNING):
+                return existing
+            r.set(dedup_key, job_id, ex=timeout)
+
+        self.save({'id': job_id,
+                   'kind': kind,
+                   'user_id': user_id,
+                   'args': args,
+                   'status': QUEUED,
+                   'progress': 'Queued.',
+                   'result': None,
+                   'error': None,
+                   'dedup_key': dedup_key,
+                   'created_at': time.time()})
+        r.lpush(self.queue_key, job_id)
+        self.start_workers(current_app._get_current_object())
+        return job_id
+
+    def run(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            # expired while queued
+            return
+        job['status'] = RUNNING
+        job['progress'] = 'Started.'
+        job['attempts'] = job.get('attempts', 0) + 1
+        self.save(job)
+
+        def progress(message):
+            job['progress'] = message
+            self.save(job)
+
+        start = time.time()
+        try:
+            job['result'] = self.handlers[job['kind']](job['user_id'], progress, **job['args'])
+            job['status'] = DONE
+            job['progress'] = 'Done in {:.1f}s.'.format(time.time() - start)
+        except Exception as e:
+            current_app.logger.exception('job {} of user {} failed'.format(job_id, job['user_id']))
+            job['status'] = FAILED
+            job['error'] = str(e) or type(e).__name__
+        finally:
+            self.save(job)
+            r = get_redis()
+            if r.get(job['dedup_key']) == job_id:
+                r.delete(job['dedup_key'])
+
+    def work(self, app, stop=None):
+        """Run queued jobs until `stop` is set.
+        """
+        timeout = app.config.get('JOB_POLL_TIMEOUT', 2)
+        worker_id = uuid.uuid4().hex
+        processing_key = self.processing_str.format(worker_id)
+        stopped = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(app, worker_id, stopped), daemon=True,
+                         name='job-heartbeat-{}'.format(worker_id)).start()
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    with app.app_context():
+                        r = get_redis()
+                        job_id = r.brpoplpush(self.queue_key, processing_key, timeout=timeout)
+                        if job_id is None:
+                            self.requeue_orphans()
+                            continue
+                        try:
+                            self.run(job_id)
+                        finally:
+                            r.lrem(processing_key, 1, job_id)
+                except Exception as e:
+                    app.logger.warning('job worker: {}'.format(e))
+                    time.sleep(timeout)
+        finally:
+            stopped.set()
+
+    def heartbeat(self, app, worker_id, stopped):
+        """Keep the heartbeat of a worker alive until it stops.
+        """
+        timeout = app.config.get('JOB_HEARTBEAT_TIMEOUT', 30)
+        with app.app_context():
+            r = get_redis()
+            while True:
+                try:
+                    r.set(self.heartbeat_str.format(worker_id), 1, ex=timeout)
+                    r.sadd(self.workers_key, worker_id)
+                except Exception as e:
+                    app.logger.warning('job heartbeat: {}'.format(e))
+                if stopped.wait(timeout / 3):
+                    break
+            r.delete(self.heartbeat_str.format(worker_id))
+            r.srem(self.workers_key, worker_id)
+
+    def requeue_orphans(self):
+        """Queue the jobs of workers without a heartbeat again, or fail them
+        once they ran JOB_MAX_ATTEMPTS times.
+        """
+        r = get_redis()
+        max_attempts = current_app.config.get('JOB_MAX_ATTEMPTS', 2)
+        for worker_id in r.smembers(self.workers_key):
+            if r.exists(self.heartbeat_str.format(worker_id)):
+                continue
+            processing_key = self.processing_str.format(worker_id)
+            # popping claims a job, only one worker handles each
+            job_id = r.rpop(processing_key)
+            while job_id is not None:
+                job = self.get(job_id)
+                if job is not None and job.get('attempts', 0) < max_attempts:
+                    current_app.logger.warning('job {}: worker {} stopped, queued again'.format(job_id, worker_id))
+                    job['status'] = QUEUED
+                    job['progress'] = 'Queued again, the worker running it stopped.'
+                    self.save(job)
+                    r.rpush(self.queue_key, job_id)
+                elif job is not None:
+                    current_app.logger.warning('job {}: worker {} stopped, failed'.format(job_id, worker_id))
+                    job['status'] = FAILED
+                    job['error'] = 'The worker running the job stopped.'
+                    self.save(job)
+                    if r.get(job['dedup_key']) == job_id:
+                        r.delete(job['dedup_key'])
+                job_id = r.rpop(processing_key)
+            r.srem(self.workers_key, worker_id)
+
+    def start_workers(self, app):
+        """Start the JOB_LOCAL_WORKERS worker threads of this process, once.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(app.config.get('JOB_LOCAL_WORKERS', 2)):
+                threading.Thread(target=self.work, args=(app,), daemon=True,
+                                 name='job-worker-{}'.format(i)).start()
+
+
+job_queue = JobQueue()
@@ -0,0 +1,105 @@
+import re
+import json
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from evelogi.esi import esi
+from evelogi.utils import get_redis, flight_lock, release_flight_lock
+from evelogi.metrics import metrics
+from evelogi.orders import OrderArray
+
+JITA_REGION_ID = 10000002
+JITA_STATION_ID = 60003760
+
+
+def snapshot_namespace(name):
+    """Cache namespace of a snapshot, 'structure_candidates' for 'structure_candidates_12'.
+    """
+    return re.sub(r'_\d+$', '', name)
+
+
+def snapshot_key(name, suffix):
+    """Redis key of a snapshot. The name is the hash tag, so every key of a
+    snapshot lives in one Redis Cluster slot and can be written together.
+    """
+    return '{{{}}}_{}'.format(name, suffix)
+
+
+def publish_snapshot(name, data):
+    """Publish data as a new version of a snapshot.
+
+    The payload is written under a versioned key first and the current
+    pointer is swapped afterwards in one transaction, so readers only ever
+    see a complete snapshot. The superseded version expires after
+    SNAPSHOT_GRACE seconds, long enough for slow readers to finish.
+    """
+    r = get_redis()
+    version = r.incr(snapshot_key(name, 'version'))
+    snapshot = {
+        'version': version,
+        'updated_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'published_at': time.time(),
+        'data': data,
+    }
+    raw = json.dumps(snapshot)
+    pipe = r.pipeline()
+    pipe.set(snapshot_key(name, version), raw, ex=current_app.config.get('SNAPSHOT_TIMEOUT', 86400))
+    pipe.getset(snapshot_key(name, 'current'), version)
+    _, previous = pipe.execute()
+    if previous is not None and int(previous) != version:
+        r.expire(snapshot_key(name, previous), current_app.config.get('SNAPSHOT_GRACE', 60))
+    metrics.cache(snapshot_namespace(name), 'write', len(raw))
+    return snapshot
+
+
+def load_snapshot(name, max_age=None):
+    """Return the current version of a snapshot, None if none is published.
+    Snapshots published more than `max_age` seconds ago count as stale reads.
+    """
+    r = get_redis()
+    namespace = snapshot_namespace(name)
+    version = r.get(snapshot_key(name, 'current'))
+    raw = r.get(snapshot_key(name, version)) if version is not None else None
+    if raw is None:
+        metrics.cache(namespace, 'miss')
+        return None
+    snapshot = json.loads(raw)
+    stale = max_age is not None and time.time() - snapshot.get('published_at', 0) > max_age
+    metrics.cache(namespace, 'stale' if stale else 'hit', len(raw))
+    return snapshot
+
+
+def get_jita_sell_orders():
+    """Every sell order of The Forge as an OrderArray, converted page by page.
+    """
+    path = esi.url('/markets/{}/orders/'.format(JITA_REGION_ID), order_type='sell')
+    return OrderArray.concat(esi.run(esi.map_pages(path, OrderArray.from_orders)))
+
+
+def refresh_jita_lowest_prices():
+    """Reduce Jita sell orders to the lowest Jita 4-4 price per type and publish it.
+    Takes about 5min on a cold cache. Only the ingest worker should call this,
+    see `flask ingest-jita`. Returns None if another worker is already refreshing.
+    """
+    lock = flight_lock('jita_sell_orders', timeout=current_app.config.get('JITA_INGEST_INTERVAL', 300) * 4)
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        with metrics.stage('jita_fetch'):
+            type_ids, prices = get_jita_sell_orders().at_locations([JITA_STATION_ID]).min_by_type()
+        # json object keys are strings, keep type ids as ints
+        return publish_snapshot('jita_lowest_prices', list(zip(type_ids.tolist(), prices.tolist())))
+    finally:
+        release_flight_lock(lock)
+
+
+def get_jita_lowest_prices():
+    """Latest snapshot of the lowest Jita 4-4 sell price per type, None until
+    the ingest worker has run. `data` maps type id to price.
+    """
+    snapshot = load_snapshot('jita_lowest_prices')
+    if snapshot is not None:
+        snapshot['data'] = dict(snapshot['data'])
+    return snapshot
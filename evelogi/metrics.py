@@ -0,0 +1,343 @@
+import os
+import re
+import hmac
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from collections import Counter
+from urllib.parse import urlparse
+
+from flask import g, request, abort, has_app_context, has_request_context, Response
+
+# name: (type, help)
+METRICS = {
+    'evelogi_stage_seconds': ('histogram', 'Duration of the trade pipeline stages.'),
+    'evelogi_request_seconds': ('histogram', 'Duration of the requests per endpoint.'),
+    'evelogi_esi_requests_total': ('counter', 'ESI requests per endpoint and status, error for failed connections.'),
+    'evelogi_esi_response_bytes_total': ('counter', 'Body bytes of the ESI responses per endpoint.'),
+    'evelogi_cache_operations_total': ('counter', 'Cache lookups per namespace and result, hit, miss or stale, and writes.'),
+    'evelogi_cache_bytes_total': ('counter', 'Bytes read and written per cache namespace and result.'),
+}
+CACHE_RESULTS = ('hit', 'miss', 'stale', 'write')
+# namespace: key pattern of its Redis keys, None for caches kept elsewhere
+CACHE_NAMESPACES = {
+    'esi_response': 'esi_response_*',
+    'access_token': 'access_token_*',
+    'jwks': 'eve_jwks',
+    'structure_data': '{cache_prefix}structure_data_*',
+    'jita_lowest_prices': '{jita_lowest_prices}_*',
+    'structure_candidates': '{structure_candidates_*',
+    'order_book': '{order_book_*',
+    'month_volume': None,
+}
+CACHE_SERIES = re.compile(r'^(evelogi_cache_operations_total|evelogi_cache_bytes_total)'
+                          r'\{namespace="([^"]*)",result="([^"]*)"\}$')
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+def series(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())))
+
+
+def esi_endpoint(path):
+    """Low cardinality label of an ESI url, '/markets/{id}/orders/' for
+    '.../latest/markets/10000002/orders/?page=2'.
+    """
+    path = urlparse(path).path
+    path = path[path.find('/', 1):] if path.startswith('/latest/') else path
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+class Metrics:
+    """Prometheus style counters and histograms of every process.
+
+    Increments are buffered per process and added to one Redis hash every
+    METRICS_FLUSH_INTERVAL seconds by a flusher thread, so `/metrics` of any
+    web worker covers the web workers, job workers and schedulers alike, and
+    counting never waits on Redis, not even on the ESI event loop. Requests
+    get the stages they ran in a `Server-Timing` header.
+    """
+    key = 'metrics'
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 10)
+        app.config.setdefault('METRICS_TIMING_HEADER', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+        self.app = app
+        app.extensions['metrics'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config['METRICS_ENABLED']
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        self._start_flusher()
+        with self._lock:
+            self._pending[series(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        """Count a value in the buckets of a histogram.
+        """
+        if not self.enabled:
+            return
+        self._start_flusher()
+        with self._lock:
+            for le in BUCKETS:
+                if value <= le:
+                    self._pending[series(name + '_bucket', dict(labels, le='+Inf' if le == float('inf') else le))] += 1
+            self._pending[series(name + '_sum', labels)] += value
+            self._pending[series(name + '_count', labels)] += 1
+
+    def cache(self, namespace, result, size=0, count=1):
+        """Count `count` lookups of a cache namespace, or writes with result
+        'write'. A stale result is an entry found but too old to serve as is.
+        """
+        if count:
+            self.inc('evelogi_cache_operations_total', count, namespace=namespace, result=result)
+        if size:
+            self.inc('evelogi_cache_bytes_total', size, namespace=namespace, result=result)
+
+    def cache_stats(self):
+        """Counts and bytes per cache namespace and result since the counts
+        were last reset, with the hit ratio of the lookups.
+        """
+        from evelogi.utils import get_redis
+
+        self.flush()
+        fields = CACHE_RESULTS + tuple(result + '_bytes' for result in CACHE_RESULTS)
+        stats = {namespace: dict.fromkeys(fields, 0) for namespace in CACHE_NAMESPACES}
+        for key, value in get_redis().hgetall(self.key).items():
+            match = CACHE_SERIES.match(key)
+            if match is None:
+                continue
+            name, namespace, result = match.groups()
+            field = result if name == 'evelogi_cache_operations_total' else result + '_bytes'
+            stats.setdefault(namespace, dict.fromkeys(fields, 0))[field] = float(value)
+        for namespace in stats.values():
+            lookups = namespace['hit'] + namespace['miss'] + namespace['stale']
+            namespace['hit_ratio'] = namespace['hit'] / lookups if lookups else None
+        return stats
+
+    def reset_cache_stats(self):
+        from evelogi.utils import get_redis
+
+        self.flush()
+        r = get_redis()
+        keys = [key for key in r.hkeys(self.key) if CACHE_SERIES.match(key)]
+        if keys:
+            r.hdel(self.key, *keys)
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block as a stage of the pipeline.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe('evelogi_stage_seconds', duration, stage=name)
+            if has_request_context():
+                g.setdefault('stage_timings', []).append((name, duration))
+
+    def _start_flusher(self):
+        """Start the flusher thread of this process, once per process, forked
+        workers don't inherit the thread of their parent.
+        """
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+        with self._lock:
+            if self._flusher_pid == pid:
+                return
+            if self._flusher_pid is not None:
+                # the parent flushes what it counted before the fork
+                self._pending = Counter()
+            self._flusher_pid = pid
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.app.config['METRICS_FLUSH_INTERVAL'])
+            self.flush()
+
+    def flush(self):
+        """Add the buffered increments to the shared hash.
+        """
+        # imported here, the utils import the ESI client, which reports here
+        from evelogi.utils import get_redis
+
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending or self.app is None:
+            return
+        try:
+            if has_app_context():
+                self._write(get_redis(), pending)
+            else:
+                with self.app.app_context():
+                    self._write(get_redis(), pending)
+        except Exception as e:
+            self.app.logger.warning('metrics flush failed: {}'.format(e))
+            with self._lock:
+                self._pending.update(pending)
+
+    @classmethod
+    def _write(cls, r, pending):
+        pipe = r.pipeline(transaction=False)
+        for key, value in pending.items():
+            pipe.hincrbyfloat(cls.key, key, value)
+        pipe.execute()
+
+    def render(self):
+        """The shared metrics and the gauges of this process in the Prometheus
+        text format.
+        """
+        from evelogi.utils import get_redis, redis_pool_stats
+
+        self.flush()
+        values = get_redis().hgetall(self.key)
+        lines = []
+        for name, (kind, help_text) in sorted(METRICS.items()):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            suffixes = ('_bucket', '_sum', '_count') if kind == 'histogram' else ('',)
+            for key in sorted(values):
+                base = key.split('{', 1)[0]
+                if any(base == name + suffix for suffix in suffixes):
+                    lines.append('{} {}'.format(key, values[key]))
+
+        lines.append('# HELP evelogi_redis_connections Redis connections of the process serving this scrape.')
+        lines.append('# TYPE evelogi_redis_connections gauge')
+        for pool, stats in sorted(redis_pool_stats().items()):
+            for state, value in sorted(stats.items()):
+                lines.append('{} {}'.format(
+                    series('evelogi_redis_connections', {'pool': pool, 'state': state}), value))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        """Serve `render` to scrapers sending the METRICS_TOKEN bearer token
+        or connecting from METRICS_ALLOWED_IPS.
+        """
+        token = self.app.config['METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if not (token and hmac.compare_digest(authorization.encode(), 'Bearer {}'.format(token).encode())) and \
+                request.remote_addr not in self.app.config['METRICS_ALLOWED_IPS']:
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def _start_request(self):
+        g.request_start = time.perf_counter()
+
+    def _end_request(self, response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        duration = time.perf_counter() - start
+        self.observe('evelogi_request_seconds', duration, endpoint=request.endpoint or 'unknown')
+        if self.app.config['METRICS_TIMING_HEADER']:
+            timings = ['{};dur={:.1f}'.format(name, stage_duration * 1000)
+                       for name, stage_duration in g.pop('stage_timings', [])]
+            timings.append('total;dur={:.1f}'.format(duration * 1000))
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+
+def scan_sample(r, pattern, sample, full=False, count=1000):
+    """Up to `sample` keys matching a pattern and the number of matching keys.
+
+    The scan stops once `sample` keys are found, the count is then estimated
+    from the share of the keys scanned that matched, scaled to DBSIZE. With
+    `full` every key is scanned and the count is exact.
+    Returns (keys, count, estimated).
+    """
+    keys, matched, scanned, cursor = [], 0, 0, 0
+    while True:
+        cursor, batch = r.scan(cursor, match=pattern, count=count)
+        scanned += count
+        matched += len(batch)
+        keys.extend(batch[:sample - len(keys)])
+        if int(cursor) == 0:
+            return keys, matched, False
+        if not full and len(keys) >= sample:
+            break
+    # COUNT is a hint, SCAN looks at about that many keys per call
+    total = r.dbsize()
+    return keys, max(matched, int(matched / (min(scanned, total) or 1) * total)), True
+
+
+def cache_usage(sample=1000, full=False):
+    """Keys, estimated bytes and mean TTL of the Redis keys of every cache
+    namespace, with server wide memory and eviction counters. Sizes and TTLs
+    are measured on up to `sample` keys per namespace and scaled to the key
+    count, which is estimated by `scan_sample` unless `full`.
+    """
+    from flask import current_app
+    from redis.exceptions import ResponseError
+    from evelogi.utils import get_redis
+
+    r = get_redis()
+    usage = {}
+    for namespace, pattern in CACHE_NAMESPACES.items():
+        if pattern is None:
+            continue
+        # the hash tag braces of the snapshot patterns are not format fields
+        pattern = pattern.replace('{cache_prefix}', current_app.config.get('CACHE_KEY_PREFIX') or 'flask_cache_')
+        sampled, keys, estimated = scan_sample(r, pattern, sample, full)
+        pipe = r.pipeline(transaction=False)
+        for key in sampled:
+            pipe.memory_usage(key)
+            pipe.ttl(key)
+        try:
+            results = pipe.execute()
+        except ResponseError:
+            # MEMORY USAGE is missing on old or proxied servers, fall back to the value size
+            pipe = r.pipeline(transaction=False)
+            for key in sampled:
+                pipe.strlen(key)
+                pipe.ttl(key)
+            results = pipe.execute()
+        sizes = [size or 0 for size in results[0::2]]
+        ttls = [ttl for ttl in results[1::2] if ttl is not None and ttl >= 0]
+        usage[namespace] = {
+            'keys': keys,
+            'estimated': estimated,
+            'bytes': int(sum(sizes) / len(sizes) * keys) if sizes else 0,
+            'mean_ttl': sum(ttls) / len(ttls) if ttls else None,
+        }
+
+    try:
+        info = r.info()
+    except ResponseError:
+        info = {}
+    server = {name: info.get(name) for name in ('used_memory', 'maxmemory', 'maxmemory_policy',
+                                                'evicted_keys', 'expired_keys', 'keyspace_hits',
+                                                'keyspace_misses')} if info else {}
+    return usage, server
+
+
+metrics = Metrics()
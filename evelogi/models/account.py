@@ -1,12 +1,16 @@
-import os
-import base64
-import requests
+import time
+import threading
 
-from flask import current_app, abort
-from flask_login import UserMixin, AnonymousUserMixin
+from flask import current_app, abort, session
+from flask_login import UserMixin, AnonymousUserMixin, current_user
 
-from evelogi.extensions import db, cache
-from evelogi.utils import get_esi_data, validate_eve_jwt
+from evelogi.extensions import db, cache, esi, metrics
+from evelogi.esi import FetchScheduler
+from evelogi.utils import get_esi_data, single_flight, get_redis
+from evelogi.orderbook import refresh_order_books, ORDER_FIELDS
+from evelogi.orders import OrderArray
+from evelogi.tokens import token_manager
+from evelogi.exceptions import TokenRefreshError
 
 class Guest(AnonymousUserMixin):
     def can(self, permission_name):
@@ -23,23 +27,83 @@ class User(db.Model, UserMixin):
         super().__init__()
         self.set_role()
     
-    def set_role(self):
+    def set_role(self, role_name=None):
+        """Give the user a role, the Free role by default for users without one.
+        """
+        if role_name is not None:
+            # committing the change invalidates the permission table, see `mark_permissions_changed`
+            self.role = Role.query.filter_by(name=role_name).first()
+            db.session.commit()
+            return
         if self.role is None:
             self.role = Role.query.filter_by(name='Free').first()
         db.session.commit()
 
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and self.role is not None and permission in self.role.permissions
+        return permission_table.can(self.role_id, permission_name)
 
-    def get_orders(self):
-        """Retrive orders of a user.
+    def refresh_access_tokens(self):
+        """Refresh the access tokens of every character in parallel.
+        Returns a dict mapping character id to token or to the raised exception.
+        """
+        return token_manager.get_many(
+            [(character.character_id, character.refresh_tokens[0].token) for character in self.characters])
+
+    def fan_out(self, *paths):
+        """Fetch per character ESI endpoints such as '/characters/{}/orders/' for
+        every character in one scheduler pass, with at most
+        USER_FANOUT_CONCURRENCY requests in flight. Tokens are refreshed once
+        for all of them.
+
+        Returns
+            (results, errors): results maps each path to a dict of character
+            to its data, errors maps a character to the exception that made
+            one of its fetches fail.
+        """
+        characters = {character.character_id: character for character in self.characters}
+        errors = {}
+        urls = {}
+        for character_id, token in self.refresh_access_tokens().items():
+            if isinstance(token, Exception):
+                errors[characters[character_id]] = token
+                continue
+            for path in paths:
+                urls[(path, character_id)] = esi.url(path.format(character_id), token=token)
+
+        # get_json already retries, a second attempt would only delay the page
+        scheduler = FetchScheduler(esi, concurrency=current_app.config.get('USER_FANOUT_CONCURRENCY', 10),
+                                   max_attempts=1)
+        fetched, failed = esi.run(scheduler.run(list(urls), lambda item: esi.get_pages(urls[item])))
+        for path, character_id in failed:
+            error = scheduler.errors.get((path, character_id))
+            current_app.logger.warning('user: {}, fetching {} of character {} failed: {}'.format(
+                self.id, path, character_id, error))
+            errors.setdefault(characters[character_id], error)
+        results = {path: {} for path in paths}
+        for (path, character_id), data in fetched.items():
+            results[path][characters[character_id]] = data
+        return results, errors
+
+    def get_orders(self, columnar=False):
+        """Retrive orders of every character of a user, as one OrderArray
+        with `columnar`. Returns (orders, errors), see `fan_out`.
         """
-        characters = self.characters
+        path = '/characters/{}/orders/'
+        results, errors = self.fan_out(path)
+        if columnar:
+            return OrderArray.concat([OrderArray.from_orders(orders) for orders in results[path].values()]), errors
         data = []
-        for character in characters:
-            data += character.get_orders()
-        return data
+        for orders in results[path].values():
+            data += orders
+        return data, errors
+
+    def get_wallets(self):
+        """Wallet balance of every character of a user.
+        Returns (balances, errors), see `fan_out`.
+        """
+        path = '/characters/{}/wallet/'
+        results, errors = self.fan_out(path)
+        return results[path], errors
 
 # use character as table name will cause unknown error in mysql
 
@@ -63,60 +127,25 @@ class Character_(db.Model):
     def get_orders_count(self):
         return len(self.get_orders())
 
-    def get_orders(self):
-        """Retrive orders of a character.
+    def get_orders(self, columnar=False):
+        """Retrive orders of a character, as an OrderArray with `columnar`.
         """
         access_token = self.get_access_token()
-        path = "https://esi.evetech.net/latest/characters/" + \
-            str(self.character_id) + \
-            "/orders/?datasource=tranquility&token=" + access_token
+        path = esi.url('/characters/{}/orders/'.format(self.character_id), token=access_token)
         data = get_esi_data(path)
-        return data
+        return OrderArray.from_orders(data) if columnar else data
 
     def get_wallet(self):
         access_token = self.get_access_token()
-        path = 'https://esi.evetech.net/latest/characters/' + \
-            str(self.character_id) + \
-            '/wallet/?datasource=tranquility&token=' + access_token
+        path = esi.url('/characters/{}/wallet/'.format(self.character_id), token=access_token)
         data = get_esi_data(path)
         return data
 
-    @cache.memoize(600)
     def get_access_token(self):
-        form_values = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.refresh_tokens[0].token
-        }
-
-        client_id = current_app.config['CLIENT_ID']
-        eve_app_secret = os.environ.get('EVELOGI_SECRET_KEY')
-        user_pass = "{}:{}".format(client_id, eve_app_secret)
-        basic_auth = base64.urlsafe_b64encode(
-            user_pass.encode('utf-8')).decode()
-        auth_header = "Basic {}".format(basic_auth)
-
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Host": "login.eveonline.com",
-            "Authorization": auth_header
-        }
-
-        res = requests.post(
-            "https://login.eveonline.com/v2/oauth/token",
-            data=form_values,
-            headers=headers,
-        )
-
-        if res.status_code == 200:
-            data = res.json()
-            access_token = data['access_token']
-            validate_eve_jwt(access_token)
-            return access_token
-        else:
-            current_app.logger.warning(
-                "\nSSO response JSON is: {}".format(res.text))
+        try:
+            return token_manager.get(self.character_id, self.refresh_tokens[0].token)
+        except TokenRefreshError:
             abort(400)
-            
 
 
 class RefreshToken(db.Model):
@@ -141,14 +170,39 @@ class Structure(db.Model):
     character_id = db.Column(db.Integer, db.ForeignKey('character_.id'))
     character = db.relationship('Character_', back_populates='structures')
 
-    @cache.memoize(86400)
     def _get_structure_data(self):
-        path = 'https://esi.evetech.net/latest/universe/structures/' + \
-            str(self.structure_id) + '/?datasource=tranquility&token=' + \
-            self.character.get_access_token()
+        """Structure info, cached by structure id for a day.
+        """
+        key = 'structure_data_{}'.format(self.structure_id)
+        data = cache.get(key)
+        if data is not None:
+            metrics.cache('structure_data', 'hit')
+            return data
+        metrics.cache('structure_data', 'miss')
+        data = self._fetch_structure_data()
+        cache.set(key, data, timeout=86400)
+        metrics.cache('structure_data', 'write')
+        return data
+
+    @single_flight(key=lambda self: 'structure_data_{}'.format(self.structure_id))
+    def _fetch_structure_data(self):
+        path = esi.url('/universe/structures/{}/'.format(self.structure_id),
+                       token=self.character.get_access_token())
         data = get_esi_data(path)
         return data
 
+    def check_access(self):
+        """Fetch the structure with the token of its character, past the shared
+        structure data cache, which another character may have filled. Raises
+        GetESIDataError when the character can't see the structure. Returns the
+        structure name.
+        """
+        path = esi.url('/universe/structures/{}/'.format(self.structure_id),
+                       token=self.character.get_access_token())
+        data = get_esi_data(path)
+        cache.set('structure_data_{}'.format(self.structure_id), data, timeout=86400)
+        return data['name']
+
     def get_structure_data(self, field):
         data = self._get_structure_data()
         try:
@@ -156,13 +210,28 @@ class Structure(db.Model):
         except KeyError as e:
             current_app.logger.error(e)
 
-    def get_structure_orders(self):
-        """Retrive orders in a structure.
+    def get_order_book(self):
+        """Current order book snapshot of the structure, see `refresh_order_books`.
+        """
+        book = refresh_order_books([self])[self.id]
+        if isinstance(book, Exception):
+            raise book
+        return book
+
+    def get_structure_orders(self, columnar=False):
+        """Retrive orders in a structure, as an OrderArray with `columnar`.
+        """
+        book = self.get_order_book()['data']['orders']
+        if columnar:
+            columns = dict(zip(ORDER_FIELDS, zip(*book.values())))
+            columns['order_id'] = [int(order_id) for order_id in book]
+            return OrderArray.from_columns(columns, location_id=int(self.structure_id))
+        return [dict(zip(ORDER_FIELDS, order), order_id=int(order_id)) for order_id, order in book.items()]
+
+    def get_lowest_sell_prices(self):
+        """Lowest sell price per type in a structure.
         """
-        path = "https://esi.evetech.net/latest/markets/structures/" + \
-            str(self.structure_id) + "/?datasource=tranquility&token=" + \
-            self.character.get_access_token()
-        return get_esi_data(path)
+        return dict(self.get_order_book()['data']['lowest'])
 
 roles_permissions = db.Table("roles_permissions",
                             db.Column("role_id", db.Integer, db.ForeignKey("role.id")),
@@ -201,4 +270,112 @@ class Role(db.Model):
                     permission = Permission(name=permission_name)
                     db.session.add(permission)
                 role.permissions.append(permission)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+
+class PermissionTable:
+    """Permissions of every role as bitmasks, compiled from the role tables once.
+
+    Workers look at a version counter in Redis at most every
+    PERMISSION_CHECK_INTERVAL seconds and recompile when `invalidate` has
+    bumped it, so a check is a dict lookup and a bitwise and. Committing a
+    change of a user's role or of a role's permissions through the ORM bumps
+    it. Changes made behind the ORM's back are picked up after
+    PERMISSION_MAX_AGE seconds, or at once with `flask invalidate-permissions`.
+    """
+    version_key = 'permission_table_version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bits = {}
+        self._masks = {}
+        self._version = None
+        self._checked = 0
+        self._compiled = 0
+
+    def compile(self):
+        bits = {name: 1 << i for i, (name,) in
+                enumerate(db.session.query(Permission.name).order_by(Permission.id))}
+        masks = {}
+        rows = db.session.query(roles_permissions.c.role_id, Permission.name).join(
+            Permission, Permission.id == roles_permissions.c.permission_id)
+        for role_id, name in rows:
+            masks[role_id] = masks.get(role_id, 0) | bits[name]
+        return bits, masks
+
+    @property
+    def version(self):
+        """Version of the compiled table, recompiled first if it is outdated.
+        """
+        now = time.monotonic()
+        if self._version is None or \
+                now - self._checked > current_app.config.get('PERMISSION_CHECK_INTERVAL', 10):
+            version = int(get_redis().get(self.version_key) or 0)
+            with self._lock:
+                if version != self._version or \
+                        now - self._compiled > current_app.config.get('PERMISSION_MAX_AGE', 300):
+                    self._bits, self._masks = self.compile()
+                    self._version = version
+                    self._compiled = now
+                self._checked = now
+        return self._version
+
+    def can(self, role_id, permission_name):
+        self.version
+        bit = self._bits.get(permission_name, 0)
+        return role_id is not None and self._masks.get(role_id, 0) & bit != 0
+
+    def invalidate(self):
+        """Make every worker recompile, after roles or user roles have changed.
+        """
+        get_redis().incr(self.version_key)
+        with self._lock:
+            self._version = None
+
+
+permission_table = PermissionTable()
+
+
+@db.event.listens_for(User.role, 'set')
+@db.event.listens_for(User.role_id, 'set')
+def mark_role_changed(user, value, oldvalue, initiator):
+    # nobody has the role of a user that is not stored yet cached
+    if db.inspect(user).has_identity and value != oldvalue:
+        db.session.info['permissions_changed'] = True
+
+
+@db.event.listens_for(Role.permissions, 'append')
+@db.event.listens_for(Role.permissions, 'remove')
+@db.event.listens_for(Permission.roles, 'append')
+@db.event.listens_for(Permission.roles, 'remove')
+def mark_permissions_changed(target, value, initiator):
+    db.session.info['permissions_changed'] = True
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_permissions(session):
+    if session.info.pop('permissions_changed', False):
+        permission_table.invalidate()
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_permission_changes(session):
+    session.info.pop('permissions_changed', None)
+
+
+def session_can(permission_name):
+    """Check a permission of the logged in user without loading the user.
+
+    The role id is cached in the session together with the user id, the
+    permission table version and the time it was read, so any committed role
+    change invalidates the cached ids, and changes behind the ORM's back
+    after PERMISSION_MAX_AGE seconds.
+    """
+    role = session.get('role')
+    version = permission_table.version
+    if role is None or len(role) < 4 or role[0] != session.get('_user_id') or role[2] != version or \
+            time.time() - role[3] > current_app.config.get('PERMISSION_MAX_AGE', 300):
+        if not current_user.is_authenticated:
+            return False
+        role = session['role'] = [session.get('_user_id'), current_user.role_id, version, time.time()]
+    return permission_table.can(role[1], permission_name)
\ No newline at end of file
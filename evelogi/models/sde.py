@@ -0,0 +1,85 @@
+from sqlalchemy import Column, Integer, String, Text, Float, Boolean
+from sqlalchemy.orm import declarative_base
+
+# SDE tables are loaded from the CCP dumps, not created or migrated with the
+# app tables, so they live on their own metadata instead of db.Model.
+SDEBase = declarative_base()
+
+
+class InvTypes(SDEBase):
+    __tablename__ = 'invTypes'
+
+    typeID = Column(Integer, primary_key=True, autoincrement=False)
+    groupID = Column(Integer, index=True)
+    typeName = Column(String(100))
+    description = Column(Text)
+    mass = Column(Float)
+    volume = Column(Float)
+    capacity = Column(Float)
+    portionSize = Column(Integer)
+    raceID = Column(Integer)
+    basePrice = Column(Float)
+    published = Column(Boolean)
+    marketGroupID = Column(Integer)
+    iconID = Column(Integer)
+    soundID = Column(Integer)
+    graphicID = Column(Integer)
+
+
+class InvVolumes(SDEBase):
+    """Packaged volumes of ships and containers.
+    """
+    __tablename__ = 'invVolumes'
+
+    typeID = Column(Integer, primary_key=True, autoincrement=False)
+    volume = Column(Integer)
+
+
+class MapRegions(SDEBase):
+    __tablename__ = 'mapRegions'
+
+    regionID = Column(Integer, primary_key=True, autoincrement=False)
+    regionName = Column(String(100))
+    x = Column(Float)
+    y = Column(Float)
+    z = Column(Float)
+    xMin = Column(Float)
+    xMax = Column(Float)
+    yMin = Column(Float)
+    yMax = Column(Float)
+    zMin = Column(Float)
+    zMax = Column(Float)
+    factionID = Column(Integer)
+    nebula = Column(Integer)
+    radius = Column(Float)
+
+
+class MapSolarSystems(SDEBase):
+    __tablename__ = 'mapSolarSystems'
+
+    regionID = Column(Integer, index=True)
+    constellationID = Column(Integer, index=True)
+    solarSystemID = Column(Integer, primary_key=True, autoincrement=False)
+    solarSystemName = Column(String(100))
+    x = Column(Float)
+    y = Column(Float)
+    z = Column(Float)
+    xMin = Column(Float)
+    xMax = Column(Float)
+    yMin = Column(Float)
+    yMax = Column(Float)
+    zMin = Column(Float)
+    zMax = Column(Float)
+    luminosity = Column(Float)
+    border = Column(Boolean)
+    fringe = Column(Boolean)
+    corridor = Column(Boolean)
+    hub = Column(Boolean)
+    international = Column(Boolean)
+    regional = Column(Boolean)
+    constellation = Column(Boolean)
+    security = Column(Float, index=True)
+    factionID = Column(Integer)
+    radius = Column(Float)
+    sunTypeID = Column(Integer)
+    securityClass = Column(String(2))
@@ -1,10 +1,127 @@
-from evelogi.blueprints.main import index
-from sqlalchemy.sql.expression import update
+from datetime import date, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
 from evelogi.extensions import db
 
+
+def window_volume(days, window_start):
+    """Volume of the ESI history days from `window_start` on.
+    """
+    # iso dates compare in date order
+    since = window_start.isoformat()
+    return sum(day['volume'] for day in days if day['date'] >= since)
+
+
+class MarketHistory(db.Model):
+    """Daily market history of a type in a region.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    region_id = db.Column(db.Integer, nullable=False)
+    type_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    volume = db.Column(db.BigInteger, nullable=False)
+    average = db.Column(db.Float)
+    order_count = db.Column(db.Integer)
+
+    # also the index behind the per region range queries
+    __table_args__ = (db.UniqueConstraint('region_id', 'type_id', 'date',
+                                          name='uq_market_history_region_type_date'),)
+
+    @staticmethod
+    def last_dates(region_id):
+        """Latest stored day of every type in a region.
+        """
+        rows = db.session.query(MarketHistory.type_id, func.max(MarketHistory.date)).filter(
+            MarketHistory.region_id == region_id).group_by(MarketHistory.type_id)
+        return dict(rows)
+
+
 class MonthVolume(db.Model):
+    """Rolling 30 day volume of a type in a region, as of `update_time`.
+    """
     id = db.Column(db.Integer, primary_key=True)
     type_id = db.Column(db.Integer, nullable=False, index=True)
     region_id = db.Column(db.Integer, nullable=False, index=True)
     volume = db.Column(db.BigInteger, nullable=False)
-    update_time = db.Column(db.Date, nullable=False)
\ No newline at end of file
+    update_time = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('region_id', 'type_id', name='uq_month_volume_region_type'),)
+
+    @staticmethod
+    def region_volumes(region_id):
+        """Every month volume of a region in one indexed query.
+        """
+        rows = MonthVolume.query.filter_by(region_id=region_id).populate_existing()
+        return {row.type_id: row for row in rows}
+
+    @staticmethod
+    def append_history(region_id, histories, today=None):
+        """Append new days of history and roll the 30 day sums forward.
+
+        Days that left the window since a sum was last updated are read back
+        from MarketHistory and subtracted, so the full history is never
+        rescanned. History older than HISTORY_RETENTION_DAYS is pruned, sums
+        last updated too long ago for their departed days to be kept are
+        summed again from the stored window instead.
+
+        Args:
+            histories: maps type id to the ESI history days newer than the
+                last stored day of that type.
+        Returns
+            dict: the updated volume of every type in `histories`.
+        """
+        today = today or date.today()
+        window_start = today - timedelta(days=30)
+        retention_start = today - timedelta(
+            days=current_app.config.get('HISTORY_RETENTION_DAYS', 90))
+
+        month_volumes = MonthVolume.region_volumes(region_id)
+        stale = {type_id for type_id in histories
+                 if type_id in month_volumes and month_volumes[type_id].update_time < today}
+        # the first departed day was pruned already, the delta would miss it
+        recount = {type_id for type_id in stale
+                   if month_volumes[type_id].update_time - timedelta(days=30) < retention_start}
+        stale -= recount
+        if recount:
+            sums = dict(db.session.query(MarketHistory.type_id, func.sum(MarketHistory.volume)).filter(
+                MarketHistory.region_id == region_id,
+                MarketHistory.type_id.in_(recount),
+                MarketHistory.date >= window_start).group_by(MarketHistory.type_id))
+            for type_id in recount:
+                month_volumes[type_id].volume = int(sums.get(type_id) or 0)
+        if stale:
+            oldest = min(month_volumes[type_id].update_time for type_id in stale) - timedelta(days=30)
+            left = db.session.query(MarketHistory.type_id, MarketHistory.date, MarketHistory.volume).filter(
+                MarketHistory.region_id == region_id,
+                MarketHistory.date >= oldest,
+                MarketHistory.date < window_start)
+            for type_id, day, volume in left:
+                if type_id in stale and day >= month_volumes[type_id].update_time - timedelta(days=30):
+                    month_volumes[type_id].volume -= volume
+
+        rows = []
+        for type_id, days in histories.items():
+            month_volume = month_volumes.get(type_id)
+            if month_volume is None:
+                month_volume = MonthVolume(type_id=type_id, region_id=region_id, volume=0)
+                db.session.add(month_volume)
+                month_volumes[type_id] = month_volume
+            for day in days:
+                day_date = date.fromisoformat(day['date'])
+                if day_date >= retention_start:
+                    rows.append({'region_id': region_id,
+                                 'type_id': type_id,
+                                 'date': day_date,
+                                 'volume': day['volume'],
+                                 'average': day.get('average'),
+                                 'order_count': day.get('order_count')})
+            month_volume.volume += window_volume(days, window_start)
+            month_volume.update_time = today
+
+        db.session.bulk_insert_mappings(MarketHistory, rows)
+        MarketHistory.query.filter(MarketHistory.region_id == region_id,
+                                   MarketHistory.date < retention_start).delete(synchronize_session=False)
+        db.session.commit()
+        return {type_id: month_volumes[type_id].volume for type_id in histories}
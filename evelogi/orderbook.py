@@ -0,0 +1,187 @@
+import time
+import asyncio
+
+from flask import current_app
+
+from evelogi.esi import esi
+from evelogi.utils import get_redis, flight_lock, release_flight_lock, ESIResponseCache
+from evelogi.market import publish_snapshot, load_snapshot, snapshot_key
+from evelogi.exceptions import SingleFlightTimeout
+
+# fields of the compact orders kept in a book, keyed by order id, every
+# field of an ESI market order but the id
+ORDER_FIELDS = ('type_id', 'price', 'volume_remain', 'is_buy_order', 'issued',
+                'location_id', 'duration', 'range', 'min_volume', 'volume_total')
+TYPE_ID, PRICE, VOLUME_REMAIN, IS_BUY_ORDER, ISSUED = range(5)
+
+
+def book_name(structure_id):
+    return 'order_book_{}'.format(structure_id)
+
+
+def compact(order):
+    return [order[field] for field in ORDER_FIELDS]
+
+
+def diff_orders(old, new):
+    """Delta between two books mapping order id to compact order.
+    Returns
+        dict: 'new' and 'changed' map order id to the order in `new`,
+        'removed' maps order id to the order in `old`.
+    """
+    delta = {'new': {}, 'changed': {}, 'removed': {}}
+    for order_id, order in new.items():
+        previous = old.get(order_id)
+        if previous is None:
+            delta['new'][order_id] = order
+        elif previous != order:
+            delta['changed'][order_id] = order
+    for order_id, order in old.items():
+        if order_id not in new:
+            delta['removed'][order_id] = order
+    return delta
+
+
+def lowest_sell_prices(orders, type_ids=None):
+    """Lowest sell price per type of a book, of `type_ids` only if given.
+    """
+    lowest = {}
+    for order in orders.values():
+        if order[IS_BUY_ORDER] or (type_ids is not None and order[TYPE_ID] not in type_ids):
+            continue
+        if order[PRICE] < lowest.get(order[TYPE_ID], float('inf')):
+            lowest[order[TYPE_ID]] = order[PRICE]
+    return lowest
+
+
+def update_lowest_prices(lowest, old, new, delta):
+    """Apply a delta to the lowest sell price per type of `old` in place.
+
+    New and cheaper orders lower a price directly. Only types whose lowest
+    order was removed or repriced upwards are recomputed from `new`.
+    Returns the set of type ids whose price changed.
+    """
+    recompute = set()
+    for order in delta['removed'].values():
+        if not order[IS_BUY_ORDER] and order[PRICE] <= lowest.get(order[TYPE_ID], float('inf')):
+            recompute.add(order[TYPE_ID])
+    for order_id, order in delta['changed'].items():
+        previous = old[order_id]
+        if not previous[IS_BUY_ORDER] and previous[PRICE] <= lowest.get(previous[TYPE_ID], float('inf')) \
+                and (order[PRICE] > previous[PRICE] or order[IS_BUY_ORDER]):
+            recompute.add(previous[TYPE_ID])
+
+    changed = set()
+    for order in list(delta['new'].values()) + list(delta['changed'].values()):
+        if not order[IS_BUY_ORDER] and order[TYPE_ID] not in recompute and \
+                order[PRICE] < lowest.get(order[TYPE_ID], float('inf')):
+            lowest[order[TYPE_ID]] = order[PRICE]
+            changed.add(order[TYPE_ID])
+
+    if recompute:
+        recomputed = lowest_sell_prices(new, recompute)
+        for type_id in recompute:
+            price = recomputed.get(type_id)
+            if price != lowest.get(type_id):
+                changed.add(type_id)
+            if price is None:
+                lowest.pop(type_id, None)
+            else:
+                lowest[type_id] = price
+    return changed
+
+
+async def fetch_order_book(path):
+    """Every page of a structure market. Returns (orders, expires) where
+    orders maps order id to compact order and expires is the earliest
+    Expires of the pages.
+    """
+    data, headers = await esi.get_json(path)
+    pages = [(data, headers)]
+    pages += await asyncio.gather(
+        *[esi.get_json(path + '&page={}'.format(i)) for i in range(2, int(headers.get('X-Pages', 1)) + 1)])
+    orders = {}
+    for page, _ in pages:
+        for order in page:
+            # json object keys are strings, keep order ids as strings throughout
+            orders[str(order['order_id'])] = compact(order)
+    return orders, min(ESIResponseCache.parse_expires(headers) for _, headers in pages)
+
+
+def update_order_book(structure_id, orders, expires):
+    """Publish a fetched book as a new version of the structure's snapshot,
+    updating the lowest prices of the previous version by the delta between
+    the two. A book equal to the current version only extends its expiry.
+    Returns the current snapshot, its data holds 'orders' and 'lowest', the
+    lowest sell price per type as pairs.
+
+    A worker that waits too long for another one publishing the same book
+    gets the current snapshot, and SingleFlightTimeout without one.
+    """
+    name = book_name(structure_id)
+    r = get_redis()
+    lock = flight_lock(name)
+    if not lock.acquire(blocking_timeout=current_app.config.get('SINGLE_FLIGHT_WAIT', 60)):
+        snapshot = load_snapshot(name)
+        if snapshot is None:
+            raise SingleFlightTimeout(name)
+        return snapshot
+    try:
+        previous = load_snapshot(name)
+        old = previous['data']['orders'] if previous is not None else {}
+        delta = diff_orders(old, orders)
+        timeout = current_app.config.get('SNAPSHOT_TIMEOUT', 86400)
+        if previous is not None and not any(delta.values()):
+            # an unchanged book stays current, keep it as long as a new one
+            r.expire(snapshot_key(name, previous['version']), timeout)
+            snapshot = previous
+        else:
+            if previous is None:
+                lowest = lowest_sell_prices(orders)
+            else:
+                lowest = dict(previous['data']['lowest'])
+                update_lowest_prices(lowest, old, orders, delta)
+            snapshot = publish_snapshot(name, {'orders': orders, 'lowest': list(lowest.items())})
+            current_app.logger.info('structure: {}, order book version {}, {} new, {} changed, {} removed'.format(
+                structure_id, snapshot['version'], len(delta['new']), len(delta['changed']),
+                len(delta['removed'])))
+        r.set(snapshot_key(name, 'expires'), expires, ex=timeout)
+        return snapshot
+    finally:
+        release_flight_lock(lock)
+
+
+def refresh_order_books(structures):
+    """Order books of many structures. Books are fetched again, concurrently,
+    only once ESI's cache of them has expired.
+    Returns
+        dict: maps structure id to its snapshot or to the raised exception.
+    """
+    r = get_redis()
+    books, paths = {}, {}
+    for structure in structures:
+        name = book_name(structure.structure_id)
+        if time.time() < float(r.get(snapshot_key(name, 'expires')) or 0):
+            snapshot = load_snapshot(name)
+            if snapshot is not None:
+                books[structure.id] = snapshot
+                continue
+        try:
+            paths[structure] = esi.url('/markets/structures/{}/'.format(structure.structure_id),
+                                       token=structure.character.get_access_token())
+        except Exception as e:
+            books[structure.id] = e
+
+    async def fetch_all():
+        return await asyncio.gather(*[fetch_order_book(path) for path in paths.values()],
+                                    return_exceptions=True)
+
+    for structure, result in zip(paths, esi.run(fetch_all()) if paths else []):
+        if isinstance(result, Exception):
+            books[structure.id] = result
+            continue
+        try:
+            books[structure.id] = update_order_book(structure.structure_id, *result)
+        except Exception as e:
+            books[structure.id] = e
+    return books
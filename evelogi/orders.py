@@ -0,0 +1,120 @@
+import numpy as np
+
+# every value ESI uses for the range of an order, stored as its index
+RANGES = ('station', 'solarsystem', 'region', '1', '2', '3', '4', '5', '10', '20', '30', '40')
+RANGE_CODES = {name: code for code, name in enumerate(RANGES)}
+
+# name, dtype and the value of orders without the field, character orders have no system_id
+FIELDS = (
+    ('order_id', np.int64, 0),
+    ('type_id', np.int32, 0),
+    ('location_id', np.int64, 0),
+    ('system_id', np.int32, 0),
+    ('region_id', np.int32, 0),
+    ('price', np.float64, 0.0),
+    ('volume_remain', np.int32, 0),
+    ('volume_total', np.int32, 0),
+    ('min_volume', np.int32, 1),
+    ('duration', np.int16, 0),
+    ('is_buy_order', np.bool_, False),
+)
+ORDER_DTYPE = np.dtype([(name, dtype) for name, dtype, _ in FIELDS] +
+                       [('range', np.int8), ('issued', 'datetime64[s]')])
+
+
+class OrderArray:
+    """Market orders as one numpy structured array, about 60 bytes an order
+    against more than a kilobyte for the decoded dict.
+
+    Built page by page from ESI orders with `from_orders`, so the dicts of
+    a page can be dropped as soon as it is converted. Ranges are stored as
+    their index in RANGES and `issued` as datetime64. Columns are read with
+    `orders['price']`, masks and index arrays select orders.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else np.empty(0, dtype=ORDER_DTYPE)
+
+    @classmethod
+    def from_orders(cls, orders, **defaults):
+        """Convert ESI order dicts. `defaults` fills fields the orders lack,
+        such as the location_id of structure orders.
+        """
+        data = np.empty(len(orders), dtype=ORDER_DTYPE)
+        for name, _, default in FIELDS:
+            default = defaults.get(name, default)
+            data[name] = [order.get(name, default) for order in orders]
+        data['range'] = [RANGE_CODES.get(order.get('range'), -1) for order in orders]
+        # numpy parses iso timestamps without the timezone designator
+        data['issued'] = [order['issued'][:19] if 'issued' in order else 'NaT' for order in orders]
+        return cls(data)
+
+    @classmethod
+    def from_columns(cls, columns, **defaults):
+        """Build from a sequence of values per field, such as the transposed
+        compact orders of a book, without a dict per order. Fields without a
+        column are filled from `defaults` like `from_orders` does.
+        """
+        size = len(next(iter(columns.values()))) if columns else 0
+        data = np.empty(size, dtype=ORDER_DTYPE)
+        for name, _, default in FIELDS:
+            data[name] = columns[name] if name in columns else defaults.get(name, default)
+        data['range'] = [RANGE_CODES.get(value, -1) for value in columns['range']] \
+            if 'range' in columns else -1
+        data['issued'] = [issued[:19] for issued in columns['issued']] if 'issued' in columns else 'NaT'
+        return cls(data)
+
+    @classmethod
+    def concat(cls, arrays):
+        arrays = [array.data for array in arrays]
+        return cls(np.concatenate(arrays) if arrays else None)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return OrderArray(self.data[key])
+
+    def sells(self):
+        return self[~self.data['is_buy_order']]
+
+    def buys(self):
+        return self[self.data['is_buy_order']]
+
+    def at_locations(self, location_ids):
+        return self[np.isin(self.data['location_id'], location_ids)]
+
+    def in_systems(self, system_ids):
+        return self[np.isin(self.data['system_id'], system_ids)]
+
+    def of_types(self, type_ids):
+        return self[np.isin(self.data['type_id'], type_ids)]
+
+    def group_by_type(self, field, ufunc):
+        """Reduce a column per type with a ufunc such as np.minimum.
+        Returns (type_ids, values), sorted by type id.
+        """
+        if not len(self.data):
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=self.data.dtype[field])
+        order = np.argsort(self.data['type_id'], kind='stable')
+        type_ids = self.data['type_id'][order]
+        starts = np.flatnonzero(np.r_[True, type_ids[1:] != type_ids[:-1]])
+        return type_ids[starts], ufunc.reduceat(self.data[field][order], starts)
+
+    def min_by_type(self, field='price'):
+        return self.group_by_type(field, np.minimum)
+
+    def max_by_type(self, field='price'):
+        return self.group_by_type(field, np.maximum)
+
+    def to_dicts(self):
+        """The orders as ESI shaped dicts, for code that still wants them.
+        """
+        columns = {name: self.data[name].tolist() for name, _, _ in FIELDS}
+        columns['range'] = [RANGES[code] if code >= 0 else None for code in self.data['range'].tolist()]
+        columns['issued'] = [None if issued == 'NaT' else issued + 'Z'
+                             for issued in np.datetime_as_string(self.data['issued'], unit='s')]
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
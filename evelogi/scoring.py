@@ -0,0 +1,109 @@
+import numpy as np
+
+STOCKOUT_MARKUP = 1.3
+MIN_ESTIMATE_PROFIT = 100000000
+
+
+def score_opportunities(type_ids, jita_prices, local_prices, month_volumes, packaged_volumes,
+                        jita_to_fee, sales_tax, brokers_fee, margin_filter=0.05,
+                        volume_filter=0.5, min_estimate_profit=MIN_ESTIMATE_PROFIT, limit=None):
+    """Score Jita to structure trade opportunities over columnar inputs.
+
+    Independent of Flask, so it can run from the CLI, tests and benchmarks.
+
+    Args:
+        type_ids, jita_prices, local_prices, month_volumes, packaged_volumes:
+            equally long arrays, one element per type. A NaN local price
+            means the type is out of stock locally, it is then priced at
+            STOCKOUT_MARKUP times the Jita price. A NaN packaged volume means
+            the type is unknown and it is dropped.
+        jita_to_fee: shipping fee per m3 from Jita.
+        sales_tax, brokers_fee: in percent.
+        limit: keep only the best `limit` results.
+    Returns
+        dict: arrays of the passing types ordered by estimate profit, keyed by
+              type_id, jita_sell_price, local_price, daily_volume,
+              estimate_profit, margin and stockout.
+    """
+    type_ids = np.asarray(type_ids, dtype=np.int64)
+    jita_prices = np.asarray(jita_prices, dtype=np.float64)
+    local_prices = np.asarray(local_prices, dtype=np.float64)
+    month_volumes = np.asarray(month_volumes, dtype=np.float64)
+    packaged_volumes = np.asarray(packaged_volumes, dtype=np.float64)
+
+    stockout = np.isnan(local_prices)
+    local_prices = np.where(stockout, jita_prices * STOCKOUT_MARKUP, local_prices)
+
+    jita_to_cost = packaged_volumes * jita_to_fee
+    sales_cost = local_prices * (sales_tax * 0.01 + brokers_fee * 0.01)
+    cost = jita_prices + jita_to_cost + sales_cost
+    profit_per_item = local_prices - cost
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin = profit_per_item / cost
+    estimate_profit = profit_per_item * month_volumes
+    daily_volume = np.round(month_volumes / 30, 2)
+
+    # comparisons with NaN are False, which drops unknown types
+    mask = ((month_volumes != 0) & (profit_per_item > 0) & (margin >= margin_filter) &
+            (estimate_profit >= min_estimate_profit) & (daily_volume >= volume_filter))
+    index = np.flatnonzero(mask)
+
+    if limit is not None and limit < len(index):
+        if limit <= 0:
+            index = index[:0]
+        else:
+            top = np.argpartition(-estimate_profit[index], limit - 1)[:limit]
+            index = index[top]
+    index = index[np.argsort(-estimate_profit[index], kind='stable')]
+
+    return {
+        'type_id': type_ids[index],
+        'jita_sell_price': jita_prices[index],
+        'local_price': local_prices[index],
+        'daily_volume': daily_volume[index],
+        'estimate_profit': estimate_profit[index],
+        'margin': margin[index],
+        'stockout': stockout[index],
+    }
+
+
+def to_records(result):
+    """Turn the columnar result of `score_opportunities` into a list of dicts.
+    """
+    columns = list(result)
+    return [dict(zip(columns, row)) for row in zip(*[result[column].tolist() for column in columns])]
+
+
+def filter_candidates(table, margin_filter=0.05, volume_filter=0.5, limit=None):
+    """Apply the user filters to a candidate table, the result of
+    `score_opportunities` without margin and volume filters.
+    Rows keep their order by estimate profit.
+    """
+    columns = {name: np.asarray(values) for name, values in table.items()}
+    mask = (columns['margin'] >= margin_filter) & (columns['daily_volume'] >= volume_filter)
+    index = np.flatnonzero(mask)
+    if limit is not None:
+        index = index[:max(limit, 0)]
+    return {name: values[index] for name, values in columns.items()}
+
+
+def merge_candidates(tables, names):
+    """Merge the candidate tables of many markets into one ordered by estimate
+    profit, with `structure_id` and `market` columns.
+
+    Args:
+        tables: maps structure id to its candidate table.
+        names: maps structure id to the market name.
+    """
+    if not tables:
+        return {}
+    # empty columns of json tables come back as float arrays
+    tables = {structure_id: table for structure_id, table in tables.items() if len(table['type_id'])} or tables
+    columns = {name: np.concatenate([np.asarray(table[name]) for table in tables.values()])
+               for name in next(iter(tables.values()))}
+    columns['structure_id'] = np.concatenate([np.full(len(table['type_id']), structure_id)
+                                              for structure_id, table in tables.items()])
+    columns['market'] = np.concatenate([np.full(len(table['type_id']), names.get(structure_id), dtype=object)
+                                        for structure_id, table in tables.items()])
+    order = np.argsort(-columns['estimate_profit'], kind='stable')
+    return {name: values[order] for name, values in columns.items()}
@@ -0,0 +1,350 @@
+import os
+import re
+import bz2
+import csv
+import gzip
+import threading
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import MetaData
+
+from evelogi.extensions import db
+from evelogi.models.sde import SDEBase, InvTypes, InvVolumes, MapSolarSystems
+from evelogi.exceptions import InvTypesNotFound
+
+
+def save_array(path, array):
+    """Write an array next to `path` and move it into place, so workers that
+    memory-mapped the old file keep reading it until they restart.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+class TypeTable:
+    """Array-backed table of type names, volumes and packaged volumes.
+
+    Rows are found through a dense index array addressed by type id, so a
+    lookup is a couple of array reads and bulk lookups take an array of ids.
+    Names are stored as one utf-8 blob with offsets, which keeps every column
+    a plain array that can be memory-mapped and shared between workers.
+    """
+    files = ('index', 'type_ids', 'volumes', 'packaged_volumes', 'name_offsets', 'names')
+
+    def __init__(self, index, type_ids, volumes, packaged_volumes, name_offsets, names):
+        self.index = index
+        self.type_ids = type_ids
+        self.volumes = volumes
+        self.packaged_volumes = packaged_volumes
+        self.name_offsets = name_offsets
+        self.names = names
+
+    @classmethod
+    def build(cls, rows):
+        """Build from (type_id, name, volume, packaged_volume) rows.
+        """
+        rows = sorted(rows)
+        type_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        index = np.full(int(type_ids.max()) + 1 if len(rows) else 0, -1, dtype=np.int32)
+        index[type_ids] = np.arange(len(rows), dtype=np.int32)
+        encoded = [(row[1] or '').encode('utf-8') for row in rows]
+        name_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(name) for name in encoded])
+        names = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        volumes = np.array([row[2] for row in rows], dtype=np.float64)
+        packaged_volumes = np.array([row[3] for row in rows], dtype=np.float64)
+        return cls(index, type_ids, volumes, packaged_volumes, name_offsets, names)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.files:
+            save_array(os.path.join(path, 'type_{}.npy'.format(name)), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(*[np.load(os.path.join(path, 'type_{}.npy'.format(name)), mmap_mode=mmap_mode)
+                     for name in cls.files])
+
+    def __len__(self):
+        return len(self.type_ids)
+
+    def rows(self, type_ids):
+        """Row of every type id, -1 for unknown ones.
+        """
+        type_ids = np.asarray(type_ids, dtype=np.int64)
+        rows = np.full(type_ids.shape, -1, dtype=np.int64)
+        known = (type_ids >= 0) & (type_ids < len(self.index))
+        rows[known] = self.index[type_ids[known]]
+        return rows
+
+    def row(self, type_id):
+        if 0 <= type_id < len(self.index):
+            row = int(self.index[type_id])
+            if row >= 0:
+                return row
+        raise InvTypesNotFound(type_id)
+
+    def name(self, type_id):
+        row = self.row(type_id)
+        return bytes(self.names[self.name_offsets[row]:self.name_offsets[row + 1]]).decode('utf-8')
+
+    def packaged_volume(self, type_id):
+        return float(self.packaged_volumes[self.row(type_id)])
+
+    def bulk_names(self, type_ids):
+        """Names of many types, None for unknown ones.
+        """
+        return [None if row < 0 else
+                bytes(self.names[self.name_offsets[row]:self.name_offsets[row + 1]]).decode('utf-8')
+                for row in self.rows(type_ids).tolist()]
+
+    def bulk_packaged_volumes(self, type_ids):
+        """Packaged volumes of many types, NaN for unknown ones.
+        """
+        rows = self.rows(type_ids)
+        result = np.full(rows.shape, np.nan)
+        result[rows >= 0] = self.packaged_volumes[rows[rows >= 0]]
+        return result
+
+
+class StaticData:
+    """SDE lookup tables of a worker process.
+    """
+
+    def __init__(self, types, solar_system_ids, region_ids):
+        self.types = types
+        self.solar_system_ids = solar_system_ids
+        self.region_ids = region_ids
+        self._regions = dict(zip(solar_system_ids.tolist(), region_ids.tolist()))
+
+    @classmethod
+    def from_db(cls):
+        packaged = dict(db.session.query(InvVolumes.typeID, InvVolumes.volume))
+        rows = []
+        for type_id, name, volume in db.session.query(InvTypes.typeID, InvTypes.typeName, InvTypes.volume):
+            volume = float(volume or 0)
+            rows.append((type_id, name, volume, float(packaged.get(type_id, volume))))
+
+        systems = db.session.query(MapSolarSystems.solarSystemID, MapSolarSystems.regionID).all()
+        return cls(TypeTable.build(rows),
+                   np.array([system[0] for system in systems], dtype=np.int64),
+                   np.array([system[1] for system in systems], dtype=np.int64))
+
+    def save(self, path):
+        self.types.save(path)
+        save_array(os.path.join(path, 'solar_system_ids.npy'), self.solar_system_ids)
+        # written last, `exists` looks for it
+        save_array(os.path.join(path, 'region_ids.npy'), self.region_ids)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(TypeTable.load(path, mmap_mode),
+                   np.load(os.path.join(path, 'solar_system_ids.npy')),
+                   np.load(os.path.join(path, 'region_ids.npy')))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'region_ids.npy'))
+
+    def region_id(self, solar_system_id):
+        return self._regions[int(solar_system_id)]
+
+
+_static_data = None
+_static_data_lock = threading.Lock()
+
+
+def get_static_data():
+    """Lookup tables of this process, loaded once.
+
+    Memory-mapped from the prebuilt artifact at SDE_PATH when it exists, so
+    the pages are shared between workers, otherwise built from the database.
+    """
+    global _static_data
+    if _static_data is None:
+        with _static_data_lock:
+            if _static_data is None:
+                path = current_app.config['SDE_PATH']
+                if StaticData.exists(path):
+                    _static_data = StaticData.load(path)
+                else:
+                    current_app.logger.info('no SDE artifact at {}, building from database'.format(path))
+                    _static_data = StaticData.from_db()
+    return _static_data
+
+
+_INSERT = re.compile(r"INSERT INTO `(\w+)`(?: \(([^)]*)\))? VALUES ")
+_VALUE = re.compile(r"\s*(?:'((?:[^'\\]|\\.|'')*)'|([^,()\s]+))\s*([,)])", re.S)
+_ESCAPE = re.compile(r"\\(.)|''", re.S)
+_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+
+def _unescape(match):
+    if match.group(1) is None:
+        return "'"
+    return _ESCAPES.get(match.group(1), match.group(1))
+
+
+def _number(value):
+    if value is None or value == '' or value in ('NULL', 'None'):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def open_dump(path):
+    """Open a dump as text, decompressing .bz2 and .gz files on the fly.
+    """
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def iter_sql_dump(lines):
+    """Parse the rows of the extended INSERT statements of a mysqldump.
+
+    Statements are read one line at a time, so memory is bounded by the
+    longest statement, not by the dump.
+    Yields
+        (table, columns, values): columns is None when the statement has no
+        column list, then the order is the one of the CREATE TABLE above it.
+    """
+    create_table, columns = None, {}
+    for line in lines:
+        if line.startswith('CREATE TABLE'):
+            create_table = line.split('`')[1]
+            columns[create_table] = []
+            continue
+        if create_table is not None:
+            if line.startswith('  `'):
+                columns[create_table].append(line.split('`')[1])
+            elif line.startswith(')'):
+                create_table = None
+            continue
+        match = _INSERT.match(line)
+        if match is None:
+            continue
+        table = match.group(1)
+        names = [name.strip(' `') for name in match.group(2).split(',')] if match.group(2) \
+            else columns.get(table)
+        pos = match.end()
+        while pos < len(line) and line[pos] == '(':
+            pos += 1
+            row = []
+            while True:
+                value = _VALUE.match(line, pos)
+                if value is None:
+                    raise ValueError('Malformed INSERT INTO `{}` at offset {}'.format(table, pos))
+                quoted, bare, end = value.groups()
+                if quoted is not None:
+                    row.append(_ESCAPE.sub(_unescape, quoted))
+                else:
+                    row.append(_number(bare))
+                pos = value.end()
+                if end == ')':
+                    break
+            yield table, names, row
+            # separator between tuples, or the closing ;
+            pos += 1
+
+
+def iter_csv_dump(lines, table):
+    """Rows of a CSV dump with a header row, such as the Fuzzwork SDE conversions.
+    """
+    reader = csv.reader(lines)
+    names = next(reader)
+    for row in reader:
+        yield table, names, [_number(value) for value in row]
+
+
+def dump_table_name(path):
+    name = os.path.basename(path)
+    for suffix in ('.bz2', '.gz', '.csv', '.sql'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def load_dump(path, batch_size=10000):
+    """Bulk load one .sql or .csv dump, optionally compressed, into its SDE table.
+
+    Rows go into a fresh table without secondary indexes in batches of
+    `batch_size`, which then replaces the old table and gets its indexes
+    built, so the old table is only dropped once the new one is complete.
+    Columns that the mapping in `evelogi.models.sde` does not declare are
+    dropped.
+    Returns
+        dict: row count per loaded table.
+    """
+    with open_dump(path) as f:
+        if '.csv' in os.path.basename(path):
+            rows = iter_csv_dump(f, dump_table_name(path))
+        else:
+            rows = iter_sql_dump(f)
+        return _load_rows(rows, batch_size)
+
+
+def _load_rows(rows, batch_size):
+    counts = {}
+    table = staging = names = None
+    batch = []
+    engine = db.engine
+    try:
+        with engine.begin() as conn:
+            for table_name, columns, values in rows:
+                if table is None or table_name != table.name:
+                    if table is not None:
+                        _flush(conn, staging, batch)
+                        _swap(conn, table, staging)
+                    table = SDEBase.metadata.tables.get(table_name)
+                    if table is None:
+                        raise ValueError('{} is not a known SDE table'.format(table_name))
+                    staging = _create_staging(conn, table)
+                    names = None
+                    counts[table.name] = 0
+                if names is None:
+                    names = [(i, name) for i, name in enumerate(columns) if name in table.columns]
+                batch.append({name: values[i] for i, name in names})
+                counts[table.name] += 1
+                if len(batch) >= batch_size:
+                    _flush(conn, staging, batch)
+            if table is not None:
+                _flush(conn, staging, batch)
+                _swap(conn, table, staging)
+    finally:
+        if staging is not None:
+            staging.drop(engine, checkfirst=True)
+    return counts
+
+
+def _create_staging(conn, table):
+    staging = table.to_metadata(MetaData(), name=table.name + '_load')
+    staging.indexes.clear()
+    staging.drop(conn, checkfirst=True)
+    staging.create(conn)
+    return staging
+
+
+def _flush(conn, staging, batch):
+    if batch:
+        conn.execute(staging.insert(), batch)
+        del batch[:]
+
+
+def _swap(conn, table, staging):
+    table.drop(conn, checkfirst=True)
+    conn.exec_driver_sql('ALTER TABLE {} RENAME TO {}'.format(
+        conn.dialect.identifier_preparer.quote(staging.name),
+        conn.dialect.identifier_preparer.quote(table.name)))
+    for index in table.indexes:
+        index.create(conn)
\ No newline at end of file
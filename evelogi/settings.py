@@ -6,6 +6,91 @@ basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 class BaseConfig:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    #ESI
+    ESI_BASE_URL = 'https://esi.evetech.net/latest'
+    ESI_DATASOURCE = 'tranquility'
+    ESI_USER_AGENT = 'evelogi'
+    ESI_CONNECTION_LIMIT = 100
+    ESI_CONNECTION_LIMIT_PER_HOST = 50
+    ESI_KEEPALIVE_TIMEOUT = 60
+    ESI_TIMEOUT = 30
+    ESI_RETRIES = 3
+    # seconds, doubled on every retry
+    ESI_BACKOFF_BASE = 0.5
+    ESI_BACKOFF_MAX = 60
+    ESI_RESPONSE_CACHE_ENABLED = True
+    ESI_RESPONSE_CACHE_TIMEOUT = 86400
+    ESI_ERROR_LIMIT_THRESHOLD = 20
+    ESI_FETCH_CONCURRENCY = 20
+    ESI_FETCH_RATE = 50
+    # attempts per item, each one already retried ESI_RETRIES times by the client
+    ESI_FETCH_MAX_ATTEMPTS = 2
+    USER_FANOUT_CONCURRENCY = 10
+
+    #Redis, shared by Flask-Caching, caches, locks and queues
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    REDIS_MAX_CONNECTIONS = 50
+    REDIS_SOCKET_TIMEOUT = 5
+    REDIS_SOCKET_CONNECT_TIMEOUT = 5
+    REDIS_HEALTH_CHECK_INTERVAL = 30
+    # e.g. [('sentinel1', 26379), ('sentinel2', 26379)]
+    REDIS_SENTINELS = None
+    REDIS_SENTINEL_MASTER = 'mymaster'
+    REDIS_CLUSTER = False
+
+    #Market snapshots, the current version is kept for SNAPSHOT_TIMEOUT seconds
+    #and a superseded one for SNAPSHOT_GRACE
+    SNAPSHOT_TIMEOUT = 86400
+    SNAPSHOT_GRACE = 60
+    JITA_INGEST_INTERVAL = 300
+
+    #Single flight
+    SINGLE_FLIGHT_TIMEOUT = 300
+    SINGLE_FLIGHT_WAIT = 60
+    SINGLE_FLIGHT_STALE_TIMEOUT = 86400
+
+    #EVE SSO
+    SSO_TOKEN_URL = 'https://login.eveonline.com/v2/oauth/token'
+    SSO_JWKS_URL = 'https://login.eveonline.com/oauth/jwks'
+    # seconds, a hung SSO call holds a web worker and the token refresh lock
+    SSO_TIMEOUT = 10
+    JWKS_TIMEOUT = 86400
+    JWKS_MIN_REFRESH = 60
+    ACCESS_TOKEN_REFRESH_AHEAD = 120
+    ACCESS_TOKEN_MIN_TTL = 30
+    TOKEN_REFRESH_WORKERS = 8
+    PERMISSION_CHECK_INTERVAL = 10
+    # seconds until role changes made outside the ORM are seen
+    PERMISSION_MAX_AGE = 300
+
+    #Background jobs, also run by `flask jobs work`
+    JOB_LOCAL_WORKERS = 2
+    JOB_TIMEOUT = 900
+    JOB_RESULT_TIMEOUT = 3600
+    JOB_POLL_TIMEOUT = 2
+    # jobs of a worker silent this long are queued again, at most JOB_MAX_ATTEMPTS runs
+    JOB_HEARTBEAT_TIMEOUT = 30
+    JOB_MAX_ATTEMPTS = 2
+
+    #Trade candidates, refreshed by `flask materialize`
+    MATERIALIZE_INTERVAL = 300
+    CANDIDATES_MAX_AGE = 900
+    TRADE_RECORDS_PER_PAGE = 50
+
+    #Metrics, served at /metrics and aggregated in Redis
+    METRICS_ENABLED = True
+    METRICS_FLUSH_INTERVAL = 10
+    METRICS_TIMING_HEADER = True
+    # scrapers send 'Authorization: Bearer <token>' or connect from an allowed address
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+    # reverse proxies in front of the app, their X-Forwarded-For gives the client address
+    PROXY_FIX_X_FOR = int(os.getenv('PROXY_FIX_X_FOR', 0))
+    CACHE_STATS_SAMPLE = 1000
+
+    #SDE lookup tables, built by `flask sde load` and `flask sde build`
+    SDE_PATH = os.getenv('SDE_PATH', os.path.join(basedir, 'data', 'sde'))
+
 class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI=os.getenv('DATABASE_URL')
     SECRET_KEY='secret key'
@@ -24,6 +109,7 @@ class DevelopmentConfig(BaseConfig):
 
     #Trade
     HISTORY_VOLUME_UPDATE_INTERVAL=30
+    HISTORY_RETENTION_DAYS=90
 
 class ProductionConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
@@ -43,11 +129,24 @@ class ProductionConfig(BaseConfig):
 
     #Trade
     HISTORY_VOLUME_UPDATE_INTERVAL=7
+    HISTORY_RETENTION_DAYS=90
+
+    #Metrics, behind the reverse proxy every client looks local, scrapers need METRICS_TOKEN
+    METRICS_ALLOWED_IPS = ()
+
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:////:memory:'
 
+    SECRET_KEY = 'testing'
+    CLIENT_ID = 'testing'
+
+    #ESI and SSO, point at a local stub server such as benchmarks/stub.py
+    ESI_BASE_URL = os.getenv('ESI_BASE_URL', 'http://127.0.0.1:8080/latest')
+    SSO_TOKEN_URL = os.getenv('SSO_BASE_URL', 'http://127.0.0.1:8080') + '/v2/oauth/token'
+    SSO_JWKS_URL = os.getenv('SSO_BASE_URL', 'http://127.0.0.1:8080') + '/oauth/jwks'
+
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
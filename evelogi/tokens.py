@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import base64
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import current_app
+
+from evelogi.utils import get_redis, validate_eve_jwt, flight_lock, release_flight_lock
+from evelogi.metrics import metrics
+from evelogi.exceptions import TokenRefreshError
+
+
+def request_access_token(refresh_token):
+    """Exchange a refresh token for an access token at the EVE SSO.
+    Returns the validated JWT claims with the token under 'access_token'.
+    """
+    form_values = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+
+    client_id = current_app.config['CLIENT_ID']
+    eve_app_secret = os.environ.get('EVELOGI_SECRET_KEY')
+    user_pass = "{}:{}".format(client_id, eve_app_secret)
+    basic_auth = base64.urlsafe_b64encode(
+        user_pass.encode('utf-8')).decode()
+    auth_header = "Basic {}".format(basic_auth)
+
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Host": urlparse(current_app.config['SSO_TOKEN_URL']).netloc,
+        "Authorization": auth_header
+    }
+
+    try:
+        res = requests.post(
+            current_app.config['SSO_TOKEN_URL'],
+            data=form_values,
+            headers=headers,
+            timeout=current_app.config.get('SSO_TIMEOUT', 10),
+        )
+    except requests.RequestException as e:
+        current_app.logger.warning('SSO token request failed: {}'.format(e))
+        raise TokenRefreshError(str(e))
+
+    if res.status_code == 200:
+        data = res.json()
+        claims = validate_eve_jwt(data['access_token'])
+        claims['access_token'] = data['access_token']
+        return claims
+    else:
+        current_app.logger.warning(
+            "\nSSO response JSON is: {}".format(res.text))
+        raise TokenRefreshError(res.text)
+
+
+class TokenManager:
+    """Access tokens of every character, keyed by character id and shared
+    between workers through Redis until the `exp` of the token.
+
+    A token close to expiry is still served while a background thread
+    refreshes it. Refreshes of one character hold a lock, so concurrent
+    requests never spend the same refresh token twice.
+    """
+    key_str = 'access_token_{}'
+
+    def __init__(self):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._refreshing = set()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=current_app.config.get('TOKEN_REFRESH_WORKERS', 8),
+                    thread_name_prefix='token-refresh')
+            return self._executor
+
+    def _load(self, character_id):
+        entry = get_redis().get(self.key_str.format(character_id))
+        return json.loads(entry) if entry is not None else None
+
+    def get(self, character_id, refresh_token):
+        entry = self._load(character_id)
+        if entry is not None:
+            ttl = entry['expires'] - time.time()
+            if ttl > current_app.config.get('ACCESS_TOKEN_REFRESH_AHEAD', 120):
+                metrics.cache('access_token', 'hit')
+                return entry['access_token']
+            # served while refreshed in the background, or too close to expiry to serve
+            metrics.cache('access_token', 'stale')
+            if ttl > current_app.config.get('ACCESS_TOKEN_MIN_TTL', 30):
+                self.refresh_in_background(character_id, refresh_token)
+                return entry['access_token']
+        else:
+            metrics.cache('access_token', 'miss')
+        return self.refresh(character_id, refresh_token)
+
+    def refresh(self, character_id, refresh_token):
+        min_ttl = current_app.config.get('ACCESS_TOKEN_MIN_TTL', 30)
+        lock = flight_lock(self.key_str.format(character_id), timeout=30)
+        acquired = lock.acquire(blocking_timeout=30)
+        try:
+            # someone else may have refreshed while we waited for the lock
+            entry = self._load(character_id)
+            if entry is not None and entry['expires'] - time.time() > \
+                    current_app.config.get('ACCESS_TOKEN_REFRESH_AHEAD', 120):
+                return entry['access_token']
+            if not acquired:
+                if entry is not None and entry['expires'] - time.time() > min_ttl:
+                    return entry['access_token']
+                raise TokenRefreshError('Timed out waiting for the token of {}'.format(character_id))
+
+            claims = request_access_token(refresh_token)
+            entry = {'access_token': claims['access_token'], 'expires': claims['exp']}
+            raw = json.dumps(entry)
+            get_redis().set(self.key_str.format(character_id), raw,
+                            ex=max(int(claims['exp'] - time.time()), 1))
+            metrics.cache('access_token', 'write', len(raw))
+            return entry['access_token']
+        finally:
+            if acquired:
+                release_flight_lock(lock)
+
+    def refresh_in_background(self, character_id, refresh_token):
+        with self._lock:
+            if character_id in self._refreshing:
+                return
+            self._refreshing.add(character_id)
+        app = current_app._get_current_object()
+
+        def task():
+            try:
+                with app.app_context():
+                    self.refresh(character_id, refresh_token)
+            except Exception as e:
+                app.logger.warning('Background token refresh of {} failed: {}'.format(character_id, e))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(character_id)
+
+        self.executor.submit(task)
+
+    def get_many(self, characters):
+        """Tokens of many (character_id, refresh_token) pairs, refreshed in parallel.
+        Returns a dict mapping character id to token or to the raised exception.
+        """
+        app = current_app._get_current_object()
+
+        def task(character):
+            with app.app_context():
+                try:
+                    return self.get(*character)
+                except Exception as e:
+                    return e
+
+        tokens = self.executor.map(task, characters)
+        return {character[0]: token for character, token in zip(characters, tokens)}
+
+
+token_manager = TokenManager()
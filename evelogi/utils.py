@@ -1,34 +1,175 @@
-from asyncio import tasks
+import json
+import time
+import hashlib
+import threading
 import uuid
 import requests
-import asyncio
-import aiohttp
-from urllib.parse import urlparse, urljoin, urlencode
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse, urljoin, urlencode, parse_qsl, urlunparse
 from functools import wraps
 
 import redis
-from jose import jwt
-from jose.exceptions import ExpiredSignatureError, JWTError, JWTClaimsError
+from redis.cluster import RedisCluster
+from redis.sentinel import Sentinel
+from redis.exceptions import LockError
+from jose import jwt, jwk
+from jose.exceptions import ExpiredSignatureError, JWTError, JWTClaimsError, JWKError
 
-from flask import request, redirect, url_for, current_app, session, g, abort
+from flask import request, redirect, url_for, current_app, session, abort
 from flask_login import current_user
 
-from evelogi.exceptions import GetESIDataError, GetESIDataNotFound
+from evelogi.esi import esi
+from evelogi.exceptions import SingleFlightTimeout
+from evelogi.metrics import metrics
 
 def permission_required(permission_name):
     def decorator(func):
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            if not current_user.can(permission_name):
+            # imported here, the models import this module
+            from evelogi.models.account import session_can
+            if not session_can(permission_name):
                 abort(403)
             return func(*args)
         return decorated_function
     return decorator
 
-def get_redis():
-    if 'redis' not in g:
-        g.redis = redis.StrictRedis('localhost', 6379, charset="utf-8", decode_responses=True)
-    return g.redis
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+def create_redis(config, decode_responses=True):
+    """Build a Redis client from the REDIS_* settings.
+
+    With REDIS_SENTINELS the master is discovered through Sentinel, with
+    REDIS_CLUSTER a cluster client is built. Keys that are written together
+    share a hash tag, see `evelogi.market.snapshot_key`.
+    """
+    options = dict(max_connections=config['REDIS_MAX_CONNECTIONS'],
+                   socket_timeout=config['REDIS_SOCKET_TIMEOUT'],
+                   socket_connect_timeout=config['REDIS_SOCKET_CONNECT_TIMEOUT'],
+                   health_check_interval=config['REDIS_HEALTH_CHECK_INTERVAL'],
+                   decode_responses=decode_responses)
+    if config.get('REDIS_SENTINELS'):
+        sentinel = Sentinel(config['REDIS_SENTINELS'],
+                            socket_timeout=config['REDIS_SOCKET_TIMEOUT'])
+        return sentinel.master_for(config['REDIS_SENTINEL_MASTER'],
+                                   redis_class=redis.StrictRedis, **options)
+    if config.get('REDIS_CLUSTER'):
+        return RedisCluster.from_url(config['REDIS_URL'], **options)
+    return redis.StrictRedis.from_url(config['REDIS_URL'], **options)
+
+def init_redis(app):
+    """Create the clients of this process. redis-py fixes response decoding per
+    pool, so text callers and pickling callers such as Flask-Caching get one
+    pool each.
+    """
+    with _redis_clients_lock:
+        for decode_responses in (True, False):
+            if decode_responses not in _redis_clients:
+                _redis_clients[decode_responses] = create_redis(app.config, decode_responses)
+    # Flask-Caching takes a ready client in place of a host
+    app.config.setdefault('CACHE_REDIS_HOST', _redis_clients[False])
+
+def get_redis(decode_responses=True):
+    """Process-wide Redis client. Every caller shares its connection pool.
+    """
+    client = _redis_clients.get(decode_responses)
+    if client is None:
+        with _redis_clients_lock:
+            client = _redis_clients.get(decode_responses)
+            if client is None:
+                client = _redis_clients[decode_responses] = create_redis(
+                    current_app.config, decode_responses)
+    return client
+
+def redis_pool_stats():
+    """Connection usage of the Redis pools of this process.
+    """
+    stats = {}
+    for decode_responses, client in list(_redis_clients.items()):
+        if hasattr(client, 'connection_pool'):
+            pools = [client.connection_pool]
+        else:
+            pools = [node.redis_connection.connection_pool for node in client.get_nodes()
+                     if node.redis_connection is not None]
+        stats['text' if decode_responses else 'binary'] = {
+            'max_connections': sum(pool.max_connections for pool in pools),
+            'created': sum(pool._created_connections for pool in pools),
+            'in_use': sum(len(pool._in_use_connections) for pool in pools),
+            'idle': sum(len(pool._available_connections) for pool in pools),
+        }
+    return stats
+
+def flight_lock(name, timeout=None):
+    """Redis lock shared by every worker that computes `name`.
+    """
+    if timeout is None:
+        timeout = current_app.config.get('SINGLE_FLIGHT_TIMEOUT', 300)
+    return get_redis().lock('single_flight_{}_lock'.format(name), timeout=timeout)
+
+def release_flight_lock(lock):
+    try:
+        lock.release()
+    except LockError:
+        # expired while computing, another caller may already own it
+        pass
+
+def single_flight(key=None, timeout=None, wait_timeout=None, serve_stale=True):
+    """Coalesce concurrent calls of a function across workers.
+
+    Goes beneath `cache.cached`/`cache.memoize` so only cache misses reach it.
+    The caller that gets the lock computes the value synchronously. Everyone
+    else serves the last computed value meanwhile, or waits for the new one
+    when there is none or `serve_stale` is False. No refresh runs in the
+    background. If the computing caller fails, one of the waiters takes over,
+    and waiters that are still waiting after `wait_timeout` raise
+    SingleFlightTimeout rather than all computing at once. Return values
+    must be JSON serializable.
+
+    Args:
+        key: callable building the flight key from the call arguments,
+            defaults to the function name and arguments.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            if key is None:
+                name = ':'.join([func.__module__, func.__qualname__] +
+                                [str(arg) for arg in args] +
+                                ['{}={}'.format(k, v) for k, v in sorted(kwargs.items())])
+            else:
+                name = str(key(*args, **kwargs))
+            r = get_redis()
+            result_key = 'single_flight_{}_result'.format(name)
+            lock = flight_lock(name, timeout)
+            deadline = time.time() + (wait_timeout or current_app.config.get('SINGLE_FLIGHT_WAIT', 60))
+
+            while True:
+                if lock.acquire(blocking=False):
+                    try:
+                        value = func(*args, **kwargs)
+                        r.set(result_key, json.dumps(value),
+                              ex=current_app.config.get('SINGLE_FLIGHT_STALE_TIMEOUT', 86400))
+                        return value
+                    finally:
+                        release_flight_lock(lock)
+
+                if serve_stale:
+                    stale = r.get(result_key)
+                    if stale is not None:
+                        return json.loads(stale)
+
+                while lock.locked():
+                    if time.time() >= deadline:
+                        current_app.logger.info('single flight wait on {} gave up'.format(name))
+                        raise SingleFlightTimeout(name)
+                    time.sleep(0.1)
+                result = r.get(result_key)
+                if result is not None:
+                    return json.loads(result)
+                # the computing caller failed, let one waiter try again
+        return decorated_function
+    return decorator
 
 def is_safe_url(target):
     ref_url = urlparse(request.host_url)
@@ -55,6 +196,87 @@ def eve_oauth_url():
 
     return str(current_app.config['OAUTH_URL'] + urlencode(params))
 
+class JWKSCache:
+    """Process-wide cache of the EVE SSO signing keys.
+
+    Keys are parsed once and reused across validations. The key set is
+    mirrored in Redis so workers share one download per JWKS_TIMEOUT, and it
+    is only refreshed on expiry or when a token names an unknown `kid`.
+    """
+    redis_key = 'eve_jwks'
+
+    def __init__(self):
+        self._keys = {}
+        self._expires = 0
+        self._fetched = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, kid=None):
+        """Returns (key, alg) for a key id, the RS256 key if kid is None.
+        """
+        key = self._find(kid)
+        if key is not None and time.time() < self._expires:
+            metrics.cache('jwks', 'hit')
+            return key
+        with self._lock:
+            key = self._find(kid)
+            if key is None or time.time() >= self._expires:
+                self._refresh(kid)
+                key = self._find(kid)
+        if key is None:
+            raise JWTError('Unknown JWK kid: {}'.format(kid))
+        return key
+
+    def _find(self, kid):
+        if kid is None:
+            return next((key for key in self._keys.values() if key[1] == 'RS256'), None)
+        return self._keys.get(kid)
+
+    def _refresh(self, kid):
+        r = get_redis()
+        cached = r.get(self.redis_key)
+        if cached is not None:
+            data = json.loads(cached)
+            if kid is None or any(item.get('kid') == kid for item in data['keys']):
+                metrics.cache('jwks', 'hit', len(cached))
+                self._set(data, r.ttl(self.redis_key))
+                return
+
+        # do not let tokens with made up key ids hammer the SSO
+        if self._keys and time.time() - self._fetched < current_app.config.get('JWKS_MIN_REFRESH', 60):
+            return
+
+        metrics.cache('jwks', 'miss')
+        res = requests.get(current_app.config['SSO_JWKS_URL'],
+                           timeout=current_app.config.get('SSO_TIMEOUT', 10))
+        res.raise_for_status()
+        data = res.json()
+        if "keys" not in data:
+            current_app.logger.warning("Something went wrong when retrieving the JWK set. The returned "
+                                       "payload did not have the expected key 'keys'. \nPayload returned "
+                                       "from the SSO looks like: {}".format(data))
+            raise KeyError('keys')
+
+        self._fetched = time.time()
+        timeout = current_app.config.get('JWKS_TIMEOUT', 86400)
+        raw = json.dumps(data)
+        r.set(self.redis_key, raw, ex=timeout)
+        metrics.cache('jwks', 'write', len(raw))
+        self._set(data, timeout)
+
+    def _set(self, data, timeout):
+        keys = {}
+        for item in data['keys']:
+            try:
+                keys[item.get('kid')] = (jwk.construct(item, item['alg']), item['alg'])
+            except (JWKError, KeyError) as e:
+                current_app.logger.warning('Skipping JWK {}: {}'.format(item.get('kid'), e))
+        self._keys = keys
+        self._expires = time.time() + max(timeout, 0)
+
+
+jwks_cache = JWKSCache()
+
 def validate_eve_jwt(jwt_token):
     """Validate a JWT token retrieved from the EVE SSO.
     Args:
@@ -64,95 +286,128 @@ def validate_eve_jwt(jwt_token):
               validation errors
     """
 
-    jwk_set_url = "https://login.eveonline.com/oauth/jwks"
-
-    res = requests.get(jwk_set_url)
-    res.raise_for_status()
-
-    data = res.json()
-
     try:
-        jwk_sets = data["keys"]
-    except KeyError as e:
-        current_app.logger.warning("Something went wrong when retrieving the JWK set. The returned "
-                                   "payload did not have the expected key {}. \nPayload returned "
-                                   "from the SSO looks like: {}".format(e, data))
+        kid = jwt.get_unverified_header(jwt_token).get('kid')
+    except JWTError as e:
+        current_app.logger.warning(
+            "The JWT header was invalid: {}".format(str(e)))
         raise
 
-    jwk_set = next((item for item in jwk_sets if item["alg"] == "RS256"))
+    key, alg = jwks_cache.get_key(kid)
 
     try:
         return jwt.decode(
             jwt_token,
-            jwk_set,
-            algorithms=jwk_set["alg"],
-            issuer="login.eveonline.com"
+            key,
+            algorithms=alg,
+            issuer=("login.eveonline.com", "https://login.eveonline.com")
         )
     except ExpiredSignatureError as e:
         current_app.logger.warning(
             "The JWT token has expired: {}".format(str(e)))
         raise
+    except JWTClaimsError as e:
+        current_app.logger.warning("The issuer claim was not from login.eveonline.com or "
+                                   "https://login.eveonline.com: {}".format(str(e)))
+        raise
     except JWTError as e:
         current_app.logger.warning(
             "The JWT signature was invalid: {}".format(str(e)))
         raise
-    except JWTClaimsError as e:
-        try:
-            return jwt.decode(
-                jwt_token,
-                jwk_set,
-                algorithms=jwk_set["alg"],
-                issuer="https://login.eveonline.com"
-            )
-        except JWTClaimsError as e:
-            current_app.logger.warning("The issuer claim was not from login.eveonline.com or "
-                                       "https://login.eveonline.com: {}".format(str(e)))
-            raise
 
 def get_esi_data(path):
-    res = requests.get(path)
-    if res.status_code == 200:
-        data = res.json()
+    """Fetch an ESI endpoint, following every page, through the shared client.
+    """
+    return esi.get(path)
 
-        pages = res.headers.get("x-pages")
-        if not pages:
-            return data
-        
-        current_app.logger.info("user: {}, x-pages: {}".format(current_user.id ,pages))
-        paths = []
-        for i in range(2, int(pages) + 1):
-            paths.append(path + "&page={}".format(i))
-        results = asyncio.run(gather_esi_requests(paths))
-        for result in results:
-            data += result
-        current_app.logger.info("user: {}, finished".format(current_user.id))
-        return data
-    else:
-        current_app.logger.warning(
-            "\nSSO response JSON is: {}".format(res.json()))
-        raise GetESIDataError(res.json())
-
-async def gather_esi_requests(paths):
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for path in paths:
-            tasks.append(async_get_esi_data(path, session))
-        results = await asyncio.gather(*tasks)
-        return results
-
-async def async_get_esi_data(path, session):
-    async with session.get(path) as resp:
-        for i in range(3):
-            try:
-                result = await resp.json(content_type=None)
-            except Exception as e:
-                current_app.logger.warning('status code: {}, message: {}, attempt: {}'.format(resp.status, e, i+1))
-            else:
-                if resp.status == 200:
-                    return result
-                elif resp.status == 404:
-                    raise GetESIDataNotFound
-                else:
-                    current_app.logger.warning(
-                        "status: {} response: {}, attempt: {}".format(resp.status, result, i+1))
-        raise GetESIDataError
\ No newline at end of file
+async def async_get_esi_data(path):
+    """Fetch a single ESI page. Must run on the shared client loop, see `ESIClient.run`.
+    """
+    data, _ = await esi.get_json(path)
+    return data
+
+
+class ESIResponseCache:
+    """Conditional request cache for ESI GETs.
+
+    Entries are keyed by the url with the `token` parameter removed and hold
+    the payload together with its `ETag` and `Expires`. A fresh entry is
+    served without a request, a stale one is revalidated with
+    `If-None-Match` so an unchanged page only costs a 304.
+
+    Authenticated responses are keyed per character as well, a structure
+    market fetched with one character's docking access must not be served
+    to another one.
+    """
+    key_prefix = 'esi_response_'
+
+    def key(self, path):
+        url = urlparse(path)
+        params = parse_qsl(url.query)
+        query = [(k, v) for k, v in params if k != 'token']
+        key = self.key_prefix + urlunparse(url._replace(query=urlencode(query)))
+        tokens = [v for k, v in params if k == 'token']
+        if tokens:
+            key += '#' + self.token_owner(tokens[0])
+        return key
+
+    @staticmethod
+    def token_owner(token):
+        """The character of an access token, 'CHARACTER:EVE:<id>'. Tokens come
+        from our own refresh tokens and ESI checks them on every request.
+        """
+        try:
+            return jwt.get_unverified_claims(token)['sub']
+        except (JWTError, KeyError):
+            return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, path):
+        raw = get_redis().get(self.key(path))
+        if raw is None:
+            metrics.cache('esi_response', 'miss')
+            return None
+        entry = json.loads(raw)
+        metrics.cache('esi_response', 'hit' if self.is_fresh(entry) else 'stale', len(raw))
+        return entry
+
+    def set(self, path, data, headers):
+        """Store a 200 response, returns the stored entry.
+        """
+        entry = {
+            'etag': headers.get('ETag'),
+            'expires': self.parse_expires(headers),
+            'headers': {'X-Pages': headers.get('X-Pages', 1), 'Expires': headers.get('Expires')},
+            'data': data,
+        }
+        self._save(path, entry)
+        return entry
+
+    def refresh(self, path, entry, headers):
+        """Extend an entry after a 304.
+        """
+        entry['expires'] = self.parse_expires(headers)
+        entry['headers']['Expires'] = headers.get('Expires')
+        self._save(path, entry)
+        return entry
+
+    def _save(self, path, entry):
+        # keep the entry past its expiry so it can still be revalidated
+        timeout = int(max(entry['expires'] - time.time(), 0)) + \
+            current_app.config.get('ESI_RESPONSE_CACHE_TIMEOUT', 86400)
+        raw = json.dumps(entry)
+        get_redis().set(self.key(path), raw, ex=timeout)
+        metrics.cache('esi_response', 'write', len(raw))
+
+    @staticmethod
+    def is_fresh(entry):
+        return entry['expires'] > time.time()
+
+    @staticmethod
+    def parse_expires(headers):
+        expires = headers.get('Expires')
+        if expires is None:
+            return time.time()
+        try:
+            return parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            return time.time()
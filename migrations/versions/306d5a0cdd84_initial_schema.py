@@ -0,0 +1,104 @@
+"""initial schema
+
+Revision ID: 306d5a0cdd84
+Revises: 
+Create Date: 2026-10-18 09:58:59.771219
+
+The app tables as created by `flask initdb` before migrations were added,
+databases created that way are brought under migrations with
+`flask db stamp 306d5a0cdd84`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '306d5a0cdd84'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('month_volume',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('type_id', sa.Integer(), nullable=False),
+    sa.Column('region_id', sa.Integer(), nullable=False),
+    sa.Column('volume', sa.BigInteger(), nullable=False),
+    sa.Column('update_time', sa.Date(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_month_volume_region_id'), 'month_volume', ['region_id'], unique=False)
+    op.create_index(op.f('ix_month_volume_type_id'), 'month_volume', ['type_id'], unique=False)
+    op.create_table('permission',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=30), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('role',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=30), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('roles_permissions',
+    sa.Column('role_id', sa.Integer(), nullable=True),
+    sa.Column('permission_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['permission_id'], ['permission.id'], ),
+    sa.ForeignKeyConstraint(['role_id'], ['role.id'], )
+    )
+    op.create_table('user',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('role_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['role_id'], ['role.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('character_',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('character_id', sa.Integer(), nullable=False),
+    sa.Column('owner_hash', sa.String(length=128), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('character_id'),
+    sa.UniqueConstraint('name'),
+    sa.UniqueConstraint('owner_hash')
+    )
+    op.create_table('refresh_token',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('token', sa.String(length=256), nullable=True),
+    sa.Column('scope', sa.Text(), nullable=True),
+    sa.Column('character_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['character_id'], ['character_.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('token')
+    )
+    op.create_table('structure',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('structure_id', sa.String(length=32), nullable=False),
+    sa.Column('name', sa.String(length=20), nullable=False),
+    sa.Column('jita_to_fee', sa.Integer(), nullable=True),
+    sa.Column('jita_to_collateral', sa.Float(), nullable=True),
+    sa.Column('to_jita_fee', sa.Integer(), nullable=True),
+    sa.Column('to_jita_collateral', sa.Float(), nullable=True),
+    sa.Column('sales_tax', sa.Float(), nullable=True),
+    sa.Column('brokers_fee', sa.Float(), nullable=True),
+    sa.Column('character_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['character_id'], ['character_.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('structure')
+    op.drop_table('refresh_token')
+    op.drop_table('character_')
+    op.drop_table('user')
+    op.drop_table('roles_permissions')
+    op.drop_table('role')
+    op.drop_table('permission')
+    op.drop_index(op.f('ix_month_volume_type_id'), table_name='month_volume')
+    op.drop_index(op.f('ix_month_volume_region_id'), table_name='month_volume')
+    op.drop_table('month_volume')
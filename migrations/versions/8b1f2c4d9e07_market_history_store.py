@@ -0,0 +1,41 @@
+"""market history store
+
+Revision ID: 8b1f2c4d9e07
+Revises: 306d5a0cdd84
+Create Date: 2026-10-18 10:12:31.402518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1f2c4d9e07'
+down_revision = '306d5a0cdd84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('market_history',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('region_id', sa.Integer(), nullable=False),
+    sa.Column('type_id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('volume', sa.BigInteger(), nullable=False),
+    sa.Column('average', sa.Float(), nullable=True),
+    sa.Column('order_count', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('region_id', 'type_id', 'date', name='uq_market_history_region_type_date')
+    )
+    # month volumes are only sums, rebuilt from ESI on the next lookup, so
+    # duplicates that would break the new constraint are dropped with the rest
+    op.execute('DELETE FROM month_volume')
+    with op.batch_alter_table('month_volume') as batch_op:
+        batch_op.create_unique_constraint('uq_month_volume_region_type', ['region_id', 'type_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('month_volume') as batch_op:
+        batch_op.drop_constraint('uq_month_volume_region_type', type_='unique')
+    op.drop_table('market_history')